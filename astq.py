@@ -1,13 +1,20 @@
 import tree_sitter
 from tree_sitter import Language, Parser
 from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
 from typing import Literal, Callable
-import time
+import importlib
+import importlib.metadata
+import threading
 from enum import IntEnum
 from functools import wraps
 from dataclasses import dataclass, asdict
 from functools import partial
 
+from metrics import *
+
 
 """usecase
 ast = AST(code)
@@ -25,6 +32,14 @@ debug(ast.query(By.FuzzyType, "function"))
 debug(ast.query(By.FuzzyType, "function", layer=2))
 node = ast.query(By.FuzzyType, "function", nest=True)[0]
 debug(ast.query(By.Type, "identifier", node=node))
+debug(ast.query(By.SExpression, "(identifier) @id", node=node, nest=True))
+debug(ast.query(By.SExpression, "(identifier) @id", byte_range=(0, 64)))
+ast.matches("(function_definition declarator: (_) @decl body: (_) @body)", limit=2)
+first_calls = list(itertools.islice(ast.iquery(By.Type, "call_expression"), 3))
+debug(ast.query(By.CodeSnippet, "int a = 0;"))
+debug(ast.query(By.StructuralSnippet, "int a=0 ;"))
+ast.text(node)
+ast.texts(ast.query(By.Types, ["identifier", "primitive_type"]))
 """
 
 
@@ -66,13 +81,162 @@ def row(node: tree_sitter.Node or list[tree_sitter.Node]):
 
 
 def timer(func):
-    def wrapper(*args, **kwargs):
-        start = time.time()
-        res = func(*args, **kwargs)
-        end = time.time()
-        print(f'{func.__name__:<30} cost time: {end - start:.2f}s')
-        return res
-    return wrapper
+    """
+    把函数耗时记到metrics的"timer.函数名"下, metrics未启用时直接调用
+    """
+    return metrics.timed(f"timer.{func.__qualname__}")(func)
+
+
+class LanguageRegistry:
+    """
+    进程内共享的 Language/Parser 注册表
+    Language 只构建一次并缓存; Parser 不是线程安全的, 因此每个线程每种语言各持有一个
+    重新register一个语言名会递增它的generation, 各线程在下一次parser时发现过期再用新的Language重建
+    interface:
+        register(name, loader)
+        language(name)
+        parser(name)
+    """
+
+    def __init__(self):
+        self._loaders: dict[str, str or Callable[[], object]] = {}
+        self._languages: dict[str, Language] = {}
+        self._generations: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def register(self, name: str, loader: str or Callable[[], object] or Language):
+        """
+        param: name: 语言名, 如 "c", "java"
+        param: loader: grammar模块名(如 "tree_sitter_c"), 返回language指针的函数, 或者已构建的Language
+        """
+        with self._lock:
+            self._loaders[name] = loader
+            self._languages.pop(name, None)
+            self._generations[name] = self._generations.get(name, 0) + 1
+
+    def registered(self) -> list[str]:
+        return list(self._loaders)
+
+    def grammar_version(self, name: str) -> str:
+        """
+        grammar的版本, 模块名注册的取其发行包版本, 其他方式注册的只能给出ABI版本
+        """
+        loader = self._loaders.get(name)
+        abi = f"abi{self.language(name).version}"
+        if isinstance(loader, str):
+            try:
+                return f"{importlib.metadata.version(loader.replace('_', '-'))}+{abi}"
+            except importlib.metadata.PackageNotFoundError:
+                pass
+        return abi
+
+    def language(self, name: str) -> Language:
+        lang = self._languages.get(name)
+        if lang is not None:
+            return lang
+        with self._lock:
+            lang = self._languages.get(name)
+            if lang is None:
+                lang = self.__load(name)
+                self._languages[name] = lang
+        return lang
+
+    def parser(self, name: str) -> Parser:
+        parsers = getattr(self._local, "parsers", None)
+        if parsers is None:
+            parsers = self._local.parsers = {}
+        generation = self._generations.get(name)
+        cached = parsers.get(name)
+        if cached is None or cached[0] != generation:
+            # 先取generation再取Language, 中间被重新register时只会多重建一次, 不会用上旧的Language
+            cached = parsers[name] = (generation, Parser(self.language(name)))
+        return cached[1]
+
+    def __load(self, name: str) -> Language:
+        if name not in self._loaders:
+            raise NotImplementedError(f"unsupported language: {name}")
+        loader = self._loaders[name]
+        if isinstance(loader, Language):
+            return loader
+        if isinstance(loader, str):
+            return Language(importlib.import_module(loader).language())
+        return Language(loader())
+
+
+registry = LanguageRegistry()
+registry.register("cpp", "tree_sitter_cpp")
+registry.register("c", "tree_sitter_c")
+registry.register("java", "tree_sitter_java")
+registry.register("python", "tree_sitter_python")
+
+
+def register_language(name: str, loader: str or Callable[[], object] or Language):
+    registry.register(name, loader)
+
+
+class QueryCache:
+    """
+    所有AST共享的S-expression编译缓存, 以(Language, pattern文本)为key, LRU淘汰
+    Query上挂着范围/深度设置和执行状态, 不能在线程间共享, 所以每个线程各自编译并缓存一份, 执行时不需要加锁
+    interface:
+        get(lang, pattern)
+        info()
+        clear()
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # clear()只递增generation, 各线程在下一次get时发现过期再清空自己的缓存
+        self._generation = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def __queries(self) -> OrderedDict[tuple[Language, str], tree_sitter.Query]:
+        local = self._local
+        if getattr(local, "generation", None) != self._generation:
+            local.queries = OrderedDict()
+            local.generation = self._generation
+        return local.queries
+
+    def get(self, lang: Language, pattern: str) -> tree_sitter.Query:
+        key = (lang, pattern)
+        queries = self.__queries()
+        query = queries.get(key)
+        hit = query is not None
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if metrics.enabled:
+            metrics.count("query_cache.hit" if hit else "query_cache.miss")
+        if hit:
+            queries.move_to_end(key)
+            return query
+        query = queries[key] = lang.query(pattern)
+        while len(queries) > self.maxsize:
+            queries.popitem(last=False)
+        return query
+
+    def info(self) -> dict:
+        """
+        hits/misses是所有线程的合计, size是当前线程缓存的Query数
+        """
+        size = len(self.__queries())
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": size, "maxsize": self.maxsize}
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self.hits = 0
+            self.misses = 0
+
+
+query_cache = QueryCache()
 
 
 class By(IntEnum):
@@ -83,12 +247,90 @@ class By(IntEnum):
     FuzzyType = 4       # ok
     TypePath = 5
     SExpression = 6     # ok
-    CodeSnippet = 7
+    CodeSnippet = 7     # ok
     # LeafType = 8
+    StructuralSnippet = 9   # ok
 
 # class QRange(IntEnum):
 
 
+class TypeIndex:
+    """
+    一次先序遍历建立的 类型 -> 节点 索引, 同一类型的节点按文档顺序排列, 并记录先序序号和深度,
+    之后By.Type/By.Types/By.FuzzyType查询(包括node, depth, layer, nest)不再遍历树
+    """
+
+    def __init__(self, root: tree_sitter.Node):
+        self.nodes: dict[str, list[tree_sitter.Node]] = {}
+        self.orders: dict[str, array] = {}
+        self.depths: dict[str, array] = {}
+        # node.id -> (先序序号, 深度, 节点), 用于确定子树范围
+        # 增量解析出的树之间会共享node.id, 所以查找时还要核对是否就是这个节点
+        self.positions: dict[int, tuple[int, int, tree_sitter.Node]] = {}
+
+        cursor = root.walk()
+        order = 0
+        depth = 0
+        while True:
+            node = cursor.node
+            type = node.type
+            if type not in self.nodes:
+                self.nodes[type] = []
+                self.orders[type] = array("i")
+                self.depths[type] = array("i")
+            self.nodes[type].append(node)
+            self.orders[type].append(order)
+            self.depths[type].append(depth)
+            self.positions[node.id] = (order, depth, node)
+            order += 1
+            if cursor.goto_first_child():
+                depth += 1
+                continue
+            while not cursor.goto_next_sibling():
+                if not cursor.goto_parent():
+                    return
+                depth -= 1
+
+    @property
+    def types(self) -> list[str]:
+        return list(self.nodes)
+
+    def select(self, type_list: list[str], node: tree_sitter.Node, depth: int = None, layer: int = None,
+               nest: bool = False) -> list[tree_sitter.Node] or None:
+        """
+        type_list中各类型的节点合并后的结果, 没有depth/layer时按文档(先序)顺序, 否则按层序, 与遍历查询的顺序一致
+        node不在索引中(如来自别的树)时返回None, 由调用方回退到遍历
+        """
+        position = self.positions.get(node.id)
+        if position is None:
+            return None
+        root_order, root_depth, indexed = position
+        # 同id的节点可能来自共享子树的另一棵树, 或者修改前的同一棵树
+        if indexed != node or indexed.byte_range != node.byte_range:
+            return None
+        end_order = root_order + node.descendant_count
+
+        res = []
+        for type in type_list:
+            orders = self.orders.get(type)
+            if orders is None:
+                continue
+            nodes = self.nodes[type]
+            depths = self.depths[type]
+            for i in range(bisect_left(orders, root_order), bisect_left(orders, end_order)):
+                relative = depths[i] - root_depth
+                if depth and relative > depth:
+                    continue
+                if layer and relative != layer:
+                    continue
+                res.append(((relative, orders[i]) if depth or layer else orders[i], nodes[i]))
+        if len(type_list) > 1 or depth or layer:
+            res.sort(key=lambda item: item[0])
+        if nest:
+            res = res[:1]
+        return [n for _, n in res]
+
+
 class Preprocessing:
     @abstractmethod
     def preprocess(self, code: str):
@@ -109,56 +351,225 @@ class AST:
     提供创建, 和各种AST的遍历方法和修改方法
     """
 
-    def __init__(self, code, lang="cpp", preprocessor: Preprocessing=Raw):
+    def __init__(self, code, lang="cpp", preprocessor: Preprocessing=Raw, index: bool = False):
+        """
+        param: index: 为True时第一次类型查询会建立TypeIndex, 之后的类型查询直接查索引, 重新解析后失效
+        """
         self.lang_str = lang
-        self.parser, self.lang = self.__get_parser(lang)
+        self.lang = registry.language(lang)
+        self.use_index = index
         self.__update_ast(code, preprocessor)
 
+    def type_index(self) -> TypeIndex or None:
+        """
+        惰性建立的类型索引, use_index为False时返回None
+        """
+        if not self.use_index:
+            return None
+        if self.__type_index is None:
+            with metrics.timing("type_index.build"):
+                self.__type_index = TypeIndex(self.root_node)
+        return self.__type_index
+
+    @property
+    def parser(self) -> Parser:
+        parser = registry.parser(self.lang_str)
+        # 语言名在AST建好后被重新register时, 注册表里的Parser已是新grammar, 这里仍按self.lang解析
+        if parser.language is not self.lang:
+            parser = Parser(self.lang)
+        return parser
+
 
     def __update_ast(self, code: bytes or str, preprocessor: Preprocessing=Raw):
-        if isinstance(code, bytes):
-            self.code_bytes = code
-            code = code.decode("utf-8")
         if isinstance(code, str):
-            self.code_bytes = code.encode("utf-8")
+            code = code.encode("utf-8")
 
         self.preprocessor = preprocessor()
-        self.code = self.preprocessor.preprocess(code)
-        self.ast = self.parser.parse(self.code_bytes)
-        self.root_node = self.ast.root_node
+        self.__set_tree(code, self.__parse(code))
+
+    def __parse(self, code_bytes: bytes, old_tree: tree_sitter.Tree = None) -> tree_sitter.Tree:
+        args = (code_bytes,) if old_tree is None else (code_bytes, old_tree)
+        if not metrics.enabled:
+            return self.parser.parse(*args)
+        with metrics.timing("parse" if old_tree is None else "parse.incremental"):
+            tree = self.parser.parse(*args)
+        metrics.count("parse.bytes", len(code_bytes))
+        return tree
+
+    def text(self, node: tree_sitter.Node) -> str or None:
+        """
+        按start_byte/end_byte直接从code_bytes中取节点文本, 比node.text少一次从tree-sitter拷贝
+        """
+        if node is None:
+            return None
+        return self.code_bytes[node.start_byte:node.end_byte].decode("utf-8")
 
+    def text_view(self, node: tree_sitter.Node) -> memoryview:
+        """
+        节点文本的零拷贝视图, 需要时再decode, 如 str(view, "utf-8")
+        """
+        return self.code_view[node.start_byte:node.end_byte]
 
-    def __get_parser(self, lang: str):
-        match lang:
-            case "cpp":
-                import tree_sitter_cpp as tscpp
-                CPP_LANGUAGE = Language(tscpp.language())
-                return Parser(CPP_LANGUAGE), CPP_LANGUAGE
-            case _:
-                raise NotImplemented
+    def texts(self, nodes: list[tree_sitter.Node] or dict[str, list[tree_sitter.Node]]) -> list[str] or dict[str, list[str]]:
+        """
+        批量取文本, 输入list返回list, 输入dict(如query的By.Types/By.SExpression结果)返回同样key的dict
+        """
+        code_bytes = self.code_bytes
+        if isinstance(nodes, dict):
+            return {k: [code_bytes[n.start_byte:n.end_byte].decode("utf-8") for n in li] for k, li in nodes.items()}
+        return [code_bytes[n.start_byte:n.end_byte].decode("utf-8") for n in nodes]
+
+    def edit(self, start_byte: int, old_end_byte: int, new_end_byte: int, new_text: bytes or str) -> list[tree_sitter.Range]:
+        """
+        增量修改: 用new_text替换[start_byte, old_end_byte)的内容, 以旧树为基础重新解析, 未改动的子树会被复用
+        param: start_byte, old_end_byte: 被替换内容在旧代码中的字节范围
+        param: new_end_byte: 替换后new_text在新代码中的结束位置, 必须等于start_byte + len(new_text的utf-8编码)
+        param: new_text: 替换进去的内容
+        return: 新旧两棵树之间语法结构有变化的范围(Tree.changed_ranges), 供下游只失效受影响的部分
+        """
+        if isinstance(new_text, str):
+            new_text = new_text.encode("utf-8")
+        if new_end_byte != start_byte + len(new_text):
+            raise ValueError(f"new_end_byte {new_end_byte} does not match start_byte + len(new_text) = {start_byte + len(new_text)}")
+        return self.apply_edits([(start_byte, old_end_byte, new_text)])
+
+    def apply_edits(self, edits: list[tuple[int, int, bytes or str]]) -> list[tree_sitter.Range]:
+        """
+        一次应用多处修改, 只重新解析一次
+        param: edits: [(start_byte, old_end_byte, new_text)], 坐标都是修改前代码中的位置, 范围互不重叠
+        return: 同edit
+        """
+        old_tree = self.ast
+        new_bytes, _ = self.__edit_tree(old_tree, self.code_bytes, edits)
+        self.__set_tree(new_bytes, self.__parse(new_bytes, old_tree))
+        return old_tree.changed_ranges(self.ast)
+
+    def derive(self, edits: list[tuple[int, int, bytes or str]]) -> tuple["AST", list[tree_sitter.Range]]:
+        """
+        由当前AST增量推导出修改后代码的AST, 当前AST保持为修改前的代码
+        tree-sitter的Tree不能复制, 所以先把修改作用在当前树上解析出新树, 再把反向修改作用回去增量解析出旧树,
+        两次都是增量解析; 之后当前AST之前查询得到的节点会失效, 需要重新查询
+        param: edits: 同apply_edits
+        return: (新AST, 新旧两棵树之间语法结构有变化的范围)
+        """
+        old_bytes = self.code_bytes
+        old_tree = self.ast
+        new_bytes, inverse_edits = self.__edit_tree(old_tree, old_bytes, edits)
+
+        derived = AST.__new__(AST)
+        derived.lang_str = self.lang_str
+        derived.lang = self.lang
+        derived.preprocessor = self.preprocessor
+        derived.use_index = self.use_index
+        derived.__set_tree(new_bytes, self.__parse(new_bytes, old_tree))
+        changed_ranges = old_tree.changed_ranges(derived.ast)
+
+        self.__edit_tree(old_tree, new_bytes, inverse_edits)
+        self.__set_tree(old_bytes, self.__parse(old_bytes, old_tree))
+        return derived, changed_ranges
+
+    def __set_tree(self, code_bytes: bytes, tree: tree_sitter.Tree):
+        self.code_bytes = code_bytes
+        self.code_view = memoryview(code_bytes)
+        self.__type_index = None
+        self.code = self.preprocessor.preprocess(code_bytes.decode("utf-8"))
+        self.ast = tree
+        self.root_node = tree.root_node
+
+    @classmethod
+    def __edit_tree(cls, tree: tree_sitter.Tree, code_bytes: bytes, edits: list[tuple[int, int, bytes or str]]):
+        """
+        把edits作用到tree上(Tree.edit), 不重新解析
+        return: (修改后的代码, 把修改后的代码还原回来的反向edits)
+        """
+        edits = sorted(((start_byte, old_end_byte, new_text.encode("utf-8") if isinstance(new_text, str) else new_text)
+                        for start_byte, old_end_byte, new_text in edits), key=lambda edit: edit[0])
+        prev_end = 0
+        for start_byte, old_end_byte, _ in edits:
+            if not prev_end <= start_byte <= old_end_byte <= len(code_bytes):
+                raise ValueError(f"invalid or overlapping edit range [{start_byte}, {old_end_byte}) for {len(code_bytes)} bytes")
+            prev_end = old_end_byte
+
+        # 从后往前改, 前面的坐标不受后面修改的影响, 每处修改都能直接使用原代码中的坐标
+        for start_byte, old_end_byte, new_text in reversed(edits):
+            start_point = cls.__point(code_bytes, start_byte)
+            tree.edit(
+                start_byte=start_byte,
+                old_end_byte=old_end_byte,
+                new_end_byte=start_byte + len(new_text),
+                start_point=start_point,
+                old_end_point=cls.__point(code_bytes, old_end_byte),
+                new_end_point=cls.__advance(start_point, new_text),
+            )
+
+        pieces = []
+        inverse_edits = []
+        prev_end = 0
+        offset = 0
+        for start_byte, old_end_byte, new_text in edits:
+            pieces.append(code_bytes[prev_end:start_byte])
+            pieces.append(new_text)
+            new_start = start_byte + offset
+            inverse_edits.append((new_start, new_start + len(new_text), code_bytes[start_byte:old_end_byte]))
+            offset += len(new_text) - (old_end_byte - start_byte)
+            prev_end = old_end_byte
+        pieces.append(code_bytes[prev_end:])
+        return b"".join(pieces), inverse_edits
+
+    @staticmethod
+    def __point(code_bytes: bytes, byte: int) -> tuple[int, int]:
+        row = code_bytes.count(b"\n", 0, byte)
+        column = byte - (code_bytes.rfind(b"\n", 0, byte) + 1)
+        return row, column
+
+    @staticmethod
+    def __advance(point: tuple[int, int], text: bytes) -> tuple[int, int]:
+        rows = text.count(b"\n")
+        if rows == 0:
+            return point[0], point[1] + len(text)
+        return point[0] + rows, len(text) - (text.rfind(b"\n") + 1)
 
-    find = False
 
     def preorder(self, do: Callable, node: tree_sitter.Node = None, nest=False, leaf=False):
         """
+        基于TreeCursor的迭代先序遍历, 不受递归深度限制
         param: do: 输入为Node的函数, 对节点执行操作
-        param: node: 从哪个节点开始遍历, 若Node=None则从根节点开始遍历
+        param: node: 从哪个节点开始遍历, 若Node=None则从根节点开始遍历, 只遍历该子树
         param: nest: 需要与do配合使用, 如果do返回值为真则停止遍历
+        param: leaf: 只对叶子节点执行do
+        提前终止的状态只保存在本次遍历中, 嵌套查询和多线程并发查询同一个AST互不影响
         """
-        def order(do, node, nest):
-            if node is None:
-                node = self.root_node
-
-            if nest and self.find:
+        for current in self.iter_preorder(node, leaf):
+            if do(current) and nest:
                 return
-            # Apply the function to the current node
-            if not leaf or (leaf and len(node.children) == 0):
-                self.find = do(node)
-            # Recursively visit child nodes
-            for child in node.children:
-                order(do, child, nest=nest)
-        order(do, node, nest)
-        self.find = False
+
+    def iter_preorder(self, node: tree_sitter.Node = None, leaf: bool = False):
+        """
+        惰性产出先序遍历的节点, 调用方不再迭代时遍历即停止
+        param: node: 从哪个节点开始遍历, 若Node=None则从根节点开始遍历, 只遍历该子树
+        param: leaf: 只产出叶子节点
+        metrics启用时, 每次遍历访问过的节点数(包括leaf=True时跳过的内部节点)记在"preorder.nodes"下
+        """
+        if node is None:
+            node = self.root_node
+
+        visited = 0
+        cursor = node.walk()
+        try:
+            while True:
+                current = cursor.node
+                visited += 1
+                if not leaf or current.child_count == 0:
+                    yield current
+                if cursor.goto_first_child():
+                    continue
+                # 回溯到最近的有下一个兄弟节点的祖先, 回到子树根则结束
+                while not cursor.goto_next_sibling():
+                    if not cursor.goto_parent():
+                        return
+        finally:
+            if metrics.enabled:
+                metrics.observe("preorder.nodes", visited)
 
     def levelorder(self, do: Callable, depth: int = None, layer: int = None,
                    allover: bool = False, node: tree_sitter.Node = None, nest=False):
@@ -168,38 +579,48 @@ class AST:
         param: allover: 是否完整遍历
         param: node: 从哪个节点开始遍历, 若Node=None则从根节点开始遍历
         param: layer: 只返回某层的节点, 和depth不能同时出现, 当allover为True时失效
+        param: nest: 需要与do配合使用, 如果do返回值为真则停止遍历
         """
-        if node is None:
-            node = self.root_node
+        if allover:
+            depth = layer = None
+        elif depth is not None and layer is not None:
+            raise Exception("参数layer和depth不能同时出现")
 
-        # Initialize the queue for BFS
-        queue = [(node, 0)]  # (node, current level)
-        # result = []
-
-        while queue:
-            if nest and self.find:
+        for current_node in self.iter_levelorder(node, depth, layer):
+            if do(current_node) and nest:
                 break
-            current_node, current_layer = queue.pop(0)
-            if allover:
-                self.find = do(current_node)
-                for child in current_node.children:
-                    queue.append((child, current_layer + 1))
-            elif depth is not None and layer is not None:
-                raise Exception("参数layer和depth不能同时出现")
-            elif depth is not None:
-                if current_layer < depth:
-                    self.find = do(current_node)
-                    for child in current_node.children:
-                        queue.append((child, current_layer + 1))
-                elif current_layer == depth:
-                    self.find = do(current_node)
-            elif layer is not None:
-                if current_layer < layer:
-                    for child in current_node.children:
-                        queue.append((child, current_layer + 1))
-                elif current_layer == layer:
-                    self.find = do(current_node)
-        self.find = False
+
+    def iter_levelorder(self, node: tree_sitter.Node = None, depth: int = None, layer: int = None):
+        """
+        逐层惰性产出节点, 每层用一个新的frontier列表替换上一层, 超过depth/layer的层不会展开
+        param: node: 从哪个节点开始遍历, 若Node=None则从根节点开始遍历
+        param: depth: 产出第0~depth层的节点, 都为None时完整遍历
+        param: layer: 只产出第layer层的节点
+        metrics启用时, 每次遍历访问过的节点数(包括layer之上只展开不产出的层)记在"levelorder.nodes"下
+        """
+        if node is None:
+            node = self.root_node
+        limit = layer if layer is not None else depth
+
+        # 按层计数, 一层取出来就算访问过
+        visited = 0
+        frontier = [node]
+        current_layer = 0
+        try:
+            while frontier:
+                visited += len(frontier)
+                if layer is None or current_layer == layer:
+                    yield from frontier
+                if limit is not None and current_layer >= limit:
+                    return
+                next_frontier = []
+                for current_node in frontier:
+                    next_frontier.extend(current_node.children)
+                frontier = next_frontier
+                current_layer += 1
+        finally:
+            if metrics.enabled:
+                metrics.observe("levelorder.nodes", visited)
 
     @dataclass
     class __DFSParam:
@@ -218,7 +639,9 @@ class AST:
         layer: int
 
     def query(self, by: By, by_param: str or list[str] or Callable[[tree_sitter.Node], bool] = None,
-              node: tree_sitter.Node=None, nest=False, depth: int = None, layer: int = None, leaf: bool = False):
+              node: tree_sitter.Node=None, nest=False, depth: int = None, layer: int = None, leaf: bool = False,
+              byte_range: tuple[int, int] = None, point_range: tuple[tuple[int, int], tuple[int, int]] = None,
+              limit: int = None):
         """
         范围参数:
         node: 指定节点为根遍历
@@ -227,12 +650,30 @@ class AST:
         layer: 指定寻找范围在树的某一层, 如layer=2, 只在第二层找满足要求的
         leaf: 只找满足要求的叶子节点
         leaf, depth, layer只能有一个存在, 互不相容
+        By.SExpression专用范围参数:
+        byte_range: (start_byte, end_byte), 只匹配与该字节范围相交的节点
+        point_range: ((row, column), (row, column)), 只匹配与该行列范围相交的节点
+        limit: 只取前limit个match的captures, nest=True等价于limit=1
+        depth对By.SExpression表示pattern起始节点相对node的最大深度, 同matches, depth=0只匹配node本身, layer不支持
         条件参数:
         by, by_param
+        metrics启用时, 每次查询的耗时按模式记在"query.<By名>"下, 如"query.SExpression"
         """
+        if not metrics.enabled:
+            return self.__query(by, by_param, node, nest, depth, layer, leaf, byte_range, point_range, limit)
+        with metrics.timing(f"query.{By(by).name}"):
+            return self.__query(by, by_param, node, nest, depth, layer, leaf, byte_range, point_range, limit)
+
+    def __query(self, by: By, by_param=None, node: tree_sitter.Node = None, nest=False, depth: int = None,
+                layer: int = None, leaf: bool = False, byte_range: tuple[int, int] = None,
+                point_range: tuple[tuple[int, int], tuple[int, int]] = None, limit: int = None):
 
         if node is None:
             node = self.root_node
+        if by in (By.Type, By.Types, By.FuzzyType) and not (depth and layer) and self.use_index:
+            res = self.__query_by_index(by, by_param, node, nest, depth, layer)
+            if res is not None:
+                return res
         match by:
             case By.Type:
                 if depth or layer:
@@ -266,29 +707,195 @@ class AST:
                     return self.__query_by_predicate_DFS(predicate=by_param, node=node, nest=nest)
 
             case By.FuzzyType:
-                return self.query(by=By.Predicate, by_param=lambda node: by_param in node.type, node=node, nest=nest, depth=depth, layer=layer)
+                return self.__query(by=By.Predicate, by_param=lambda node: by_param in node.type, node=node, nest=nest, depth=depth, layer=layer)
 
             case By.SExpression:
-                query = self.lang.query(by_param)
-                return query.captures(self.root_node)
+                if nest:
+                    limit = 1
+                if limit is None:
+                    return self.__exec_sexpression(by_param, "captures", node, depth, byte_range, point_range)
+                res = {}
+                for captures in self.__matches(by_param, node, depth, byte_range, point_range, limit):
+                    for name, nodes in captures.items():
+                        res.setdefault(name, []).extend(nodes)
+                return res
 
             case By.CodeSnippet:
-                snippet_ast = AST(by_param)
-                snippet_nodes = snippet_ast.query(By.All, layer=1)
-                res = []
-                for snippet_node in snippet_nodes:
-                    for src_node in self.query(By.All):
-                        if src_node.type == snippet_node.type \
-                        and text(src_node).strip() in text(snippet_node).strip():
-                            res.append(src_node)
+                return self.__query_by_code_snippet(by_param, node, nest, structural=False)
+
+            case By.StructuralSnippet:
+                return self.__query_by_code_snippet(by_param, node, nest, structural=True)
+
+
+
+
+
+
+
+
+    def iquery(self, by: By, by_param: str or list[str] or Callable[[tree_sitter.Node], bool] = None,
+               node: tree_sitter.Node = None, depth: int = None, layer: int = None, leaf: bool = False):
+        """
+        query的惰性版本, 边遍历边产出满足条件的节点, 取够了就可以停止迭代(如itertools.islice), 不保存全部结果
+        没有depth/layer时按先序(DFS)产出, 否则按层序(BFS)产出, 参数含义同query
+        By.Types产出各类型的节点(不再按类型分组)
+        By.SExpression产出每个match的{capture名: [nodes]}
+        By.CodeSnippet/By.StructuralSnippet需要先建索引, 结果算完后逐个产出
+        """
+        if node is None:
+            node = self.root_node
+        if depth and layer:
+            raise Exception("参数layer和depth不能同时出现")
+        if metrics.enabled:
+            metrics.count(f"iquery.{By(by).name}")
+
+        match by:
+            case By.Type:
+                predicate = lambda n: n.type == by_param
+            case By.Types:
+                type_set = set(by_param)
+                predicate = lambda n: n.type in type_set
+            case By.FuzzyType:
+                predicate = lambda n: by_param in n.type
+            case By.Predicate:
+                predicate = by_param
+            case By.All:
+                predicate = None
+            case By.SExpression:
+                yield from self.matches(by_param, node, depth)
+                return
+            case By.CodeSnippet | By.StructuralSnippet:
+                yield from self.__query(by, by_param, node=node)
+                return
+            case _:
+                raise NotImplementedError(f"iquery does not support {by!r}")
+
+        # 索引里没有叶子信息, leaf=True时走遍历
+        if by in (By.Type, By.Types, By.FuzzyType) and self.use_index and not leaf:
+            types = [by_param] if by == By.Type else by_param if by == By.Types else None
+            index = self.type_index()
+            if types is None:
+                types = [type for type in index.types if by_param in type]
+            res = index.select(types, node, depth, layer)
+            if res is not None:
+                yield from res
+                return
+
+        if depth or layer:
+            nodes = self.iter_levelorder(node, depth or None, layer or None)
+        else:
+            nodes = self.iter_preorder(node, leaf)
+        if predicate is None:
+            yield from nodes
+        else:
+            for n in nodes:
+                if predicate(n):
+                    yield n
+
+    def __query_by_index(self, by: By, by_param: str or list[str], node: tree_sitter.Node, nest, depth, layer):
+        index = self.type_index()
+        match by:
+            case By.Type:
+                return index.select([by_param], node, depth, layer, nest)
+            case By.Types:
+                res = {}
+                for type in by_param:
+                    type_res = index.select([type], node, depth, layer, nest)
+                    if type_res is None:
+                        return None
+                    res[type] = type_res
                 return res
+            case By.FuzzyType:
+                # 只在不同类型的集合上做模糊匹配, 而不是每个节点
+                return index.select([type for type in index.types if by_param in type], node, depth, layer, nest)
 
+    def __query_by_code_snippet(self, snippet: str, node: tree_sitter.Node, nest: bool, structural: bool):
+        """
+        CodeSnippet: 文件中与代码片段顶层语句同类型, 且文本(去掉首尾空白)包含在该语句文本中的节点
+        StructuralSnippet: 文件中与代码片段顶层语句同类型, 且token序列(忽略空白和注释)完全相同的节点
+        只遍历一次文件, 收集片段中出现的类型的节点, 再按(类型, 文本)建索引
+        """
+        snippet_ast = AST(snippet, self.lang_str)
+        snippet_nodes = snippet_ast.__query(By.All, layer=1)
+        candidates = self.__query(By.Types, list({snippet_node.type for snippet_node in snippet_nodes}), node=node)
 
+        if structural:
+            key = self.__tokens
+            snippet_key = snippet_ast.__tokens
+        else:
+            key = lambda n: self.text(n).strip()
+            snippet_key = lambda n: snippet_ast.text(n).strip()
+        # 类型 -> {规范化文本: 节点(文档顺序)}
+        index: dict[str, dict[str or tuple, list[tree_sitter.Node]]] = {}
+        for type, nodes in candidates.items():
+            by_text = index[type] = {}
+            for candidate in nodes:
+                by_text.setdefault(key(candidate), []).append(candidate)
 
+        res = []
+        for snippet_node in snippet_nodes:
+            snippet_text = snippet_key(snippet_node)
+            by_text = index[snippet_node.type]
+            if structural:
+                res.extend(by_text.get(snippet_text, []))
+            else:
+                # 同类型的文本只在不比片段长时才做子串判断
+                matched = []
+                for text, nodes in by_text.items():
+                    if len(text) <= len(snippet_text) and text in snippet_text:
+                        matched.extend(nodes)
+                matched.sort(key=lambda n: (n.start_byte, -n.end_byte))
+                res.extend(matched)
+            if nest and res:
+                return res[:1]
+        return res
 
+    def __tokens(self, node: tree_sitter.Node) -> tuple[str, ...]:
+        tokens = []
 
+        def do(leaf: tree_sitter.Node):
+            if leaf.type != "comment":
+                tokens.append(self.text(leaf))
+        self.preorder(do, node, leaf=True)
+        return tuple(tokens)
 
+    def matches(self, pattern: str, node: tree_sitter.Node = None, depth: int = None,
+                byte_range: tuple[int, int] = None, point_range: tuple[tuple[int, int], tuple[int, int]] = None,
+                limit: int = None) -> list[dict[str, list[tree_sitter.Node]]]:
+        """
+        按match分组返回S-expression的captures, 每个match一个{capture名: [nodes]}
+        param: pattern: S-expression
+        param: node, byte_range, point_range: 同query
+        param: depth: pattern起始节点相对node的最大深度, depth=0只匹配node本身
+        param: limit: 只返回前limit个match
+        metrics启用时, 耗时记在"matches"下
+        """
+        if not metrics.enabled:
+            return self.__matches(pattern, node, depth, byte_range, point_range, limit)
+        with metrics.timing("matches"):
+            return self.__matches(pattern, node, depth, byte_range, point_range, limit)
 
+    def __matches(self, pattern: str, node: tree_sitter.Node = None, depth: int = None,
+                  byte_range=None, point_range=None, limit: int = None) -> list[dict[str, list[tree_sitter.Node]]]:
+        if node is None:
+            node = self.root_node
+        res = self.__exec_sexpression(pattern, "matches", node, depth, byte_range, point_range)
+        if limit is not None:
+            res = res[:limit]
+        return [captures for _, captures in res]
+
+    __NO_LIMIT = 0xFFFFFFFF
+
+    def __exec_sexpression(self, pattern: str, method: Literal["captures", "matches"], node: tree_sitter.Node,
+                           depth: int = None, byte_range=None, point_range=None):
+        # Query是本线程独有的, 但会被本线程之后的查询复用, 范围设置每次都要重置
+        query = query_cache.get(self.lang, pattern)
+        query.set_byte_range(byte_range or (0, self.__NO_LIMIT))
+        query.set_point_range(point_range or ((0, 0), (self.__NO_LIMIT, self.__NO_LIMIT)))
+        query.set_max_start_depth(depth if depth is not None else self.__NO_LIMIT)
+        if method == "captures":
+            return query.captures(node)
+        return query.matches(node)
 
     def __query_by_type_DFS(self, type_string: str, node: tree_sitter.Node=None, nest=False):
         res = []
@@ -314,37 +921,36 @@ class AST:
             self.levelorder(do, None, None, True, node, nest)
         return res
 
+    def __types_collector(self, type_list: list[str], nest: bool):
+        """
+        单次遍历把节点按type分桶, nest为真时每种type只收第一个, 全部找到后返回True终止遍历
+        """
+        res = {type: [] for type in type_list}
+        pending = set(res)
+
+        def do(node: tree_sitter.Node):
+            bucket = res.get(node.type)
+            if bucket is None:
+                return
+            if not nest:
+                bucket.append(node)
+            elif node.type in pending:
+                bucket.append(node)
+                pending.discard(node.type)
+                return not pending
+        return res, do
+
     def __query_by_types_BFS(self, type_list: list[str], node: tree_sitter.Node=None, nest=False, depth: int = None, layer: int = None):
-        res = {}
-        for type in type_list:
-            type_res = []
-            def do(node: tree_sitter.Node):
-                if node.type == type:
-                    type_res.append(node)
-                    if nest:
-                        return True
-
-            if depth or layer:
-                self.levelorder(do, depth, layer, False, node, nest)
-            else:
-                self.levelorder(do, None, None, True, node, nest)
-            res[type] = type_res
+        res, do = self.__types_collector(type_list, nest)
+        if depth or layer:
+            self.levelorder(do, depth, layer, False, node, nest)
+        else:
+            self.levelorder(do, None, None, True, node, nest)
         return res
 
-
     def __query_by_types_DFS(self, type_list: list[str], node, nest):
-        res = {}
-        for type in type_list:
-            type_res = []
-
-            def do(node: tree_sitter.Node):
-                if node.type == type:
-                    type_res.append(node)
-                    if nest:
-                        return True
-
-            self.preorder(do, node)
-            res[type] = type_res
+        res, do = self.__types_collector(type_list, nest)
+        self.preorder(do, node, nest)
         return res
 
     def __query_by_all_DFS(self, node: tree_sitter.Node):
@@ -393,14 +999,14 @@ class AST:
 
 
     @classmethod
-    def from_code(cls, code, lang="cpp"):
-        return cls(code, lang)
+    def from_code(cls, code, lang="cpp", index: bool = False):
+        return cls(code, lang, index=index)
 
     @classmethod
-    def from_file(cls, path, lang="cpp"):
+    def from_file(cls, path, lang="cpp", index: bool = False):
         with open(path, "r") as f:
             code = f.read()
-        return cls(code, lang)
+        return cls(code, lang, index=index)
 
 
 
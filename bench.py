@@ -0,0 +1,384 @@
+import difflib
+import itertools
+import random
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import tree_sitter
+from tree_sitter import Language, Parser
+
+from astq import *
+from cache import *
+from corpus import *
+from diff import *
+from func import *
+from oldnew import *
+
+"""
+usage
+python bench.py                 # run every benchmark
+python bench.py parser          # run a single benchmark by name
+the before/after comparisons of individual optimizations live here,
+benchsuite.py is the reproducible suite with json output for comparing commits
+"""
+
+
+def synthetic_function(i: int) -> str:
+    return f"""
+int func_{i}(int a, char *buf, size_t len)
+{{
+    int ret = 0;
+    for (size_t k = 0; k < len; k++) {{
+        if (buf[k] == '\\0')
+            break;
+        ret += buf[k] * a;
+    }}
+    if (ret > {i})
+        return helper_{i}(ret, buf);
+    return ret;
+}}
+"""
+
+
+def nested_function(depth: int) -> str:
+    """a function whose body nests `depth` if-blocks"""
+    return "int deep(int x)\n{\n" + "if (x) {\n" * depth + "x++;\n" + "}\n" * depth + "}\n"
+
+
+def wide_function(width: int) -> str:
+    """a function whose body has `width` sibling statements"""
+    return "int wide(int x)\n{\n" + "x = x + 1;\n" * width + "return x;\n}\n"
+
+
+def recursive_preorder(do, node: tree_sitter.Node):
+    """the recursive node.children preorder AST.preorder used to be"""
+    do(node)
+    for child in node.children:
+        recursive_preorder(do, child)
+
+
+def synthetic_diff(n_hunks: int, hunk_lines: int = 12, seed: int = 0) -> str:
+    """a unified diff body (no file headers) with `n_hunks` hunks of mixed context/removed/added lines"""
+    rnd = random.Random(seed)
+    pieces = []
+    old_start = new_start = 1
+    for h in range(n_hunks):
+        old_start += rnd.randint(5, 40)
+        new_start = old_start + (new_start - old_start if h else 0)
+        body = []
+        old_len = new_len = 0
+        for k in range(hunk_lines):
+            kind = rnd.random()
+            line = f"    value_{h}_{k} = compute(value_{h}_{k}, {k});"
+            if kind < 0.6:
+                body.append(" " + line)
+                old_len += 1
+                new_len += 1
+            elif kind < 0.8:
+                body.append("-" + line)
+                old_len += 1
+            else:
+                body.append("+" + line)
+                new_len += 1
+        pieces.append(f"@@ -{old_start},{old_len} +{new_start},{new_len} @@ int func_{h}(void)")
+        pieces.extend(body)
+        old_start += old_len
+        new_start += new_len
+    return "\n".join(pieces) + "\n"
+
+
+def measure(func, repeat: int = 1):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        cost = time.perf_counter() - start
+        best = cost if best is None else min(best, cost)
+    return best
+
+
+def report(name: str, cost: float, count: int):
+    print(f"{name:<40} total: {cost:8.4f}s   per item: {cost / count * 1e6:10.2f}us")
+
+
+def bench_parser(n_functions: int = 3000):
+    """cost per AST: fresh Language/Parser for every AST vs the shared registry, same AST construction both ways"""
+    import tree_sitter_cpp as tscpp
+    functions = [synthetic_function(i) for i in range(n_functions)]
+
+    class FreshAST(AST):
+        # builds its own Language and Parser, as AST did before the registry
+        def __init__(self, code, lang="cpp"):
+            self.__parser = None
+            super().__init__(code, lang)
+
+        @property
+        def parser(self) -> Parser:
+            if self.__parser is None:
+                self.lang = Language(tscpp.language())
+                self.__parser = Parser(self.lang)
+            return self.__parser
+
+    def fresh():
+        for code in functions:
+            FreshAST(code)
+
+    def shared():
+        for code in functions:
+            AST(code)
+
+    print(f"[ parser ] {n_functions} functions")
+    report("fresh Language/Parser per AST", measure(fresh, 3), n_functions)
+    report("registry (cached Language/Parser)", measure(shared, 3), n_functions)
+
+
+def bench_preorder(depth: int = 300, width: int = 20000):
+    """iterative TreeCursor preorder vs recursive node.children preorder"""
+    def count():
+        counter = [0]
+        def do(node):
+            counter[0] += 1
+        return counter, do
+
+    for name, code in (("deep", nested_function(depth)), ("wide", wide_function(width))):
+        ast = AST(code)
+        counter, do = count()
+        ast.preorder(do)
+        nodes = counter[0]
+        print(f"[ preorder ] {name} tree, {nodes} nodes")
+        report("recursive node.children", measure(lambda: recursive_preorder(do, ast.root_node), 3), nodes)
+        report("iterative TreeCursor", measure(lambda: ast.preorder(do), 3), nodes)
+
+    ast = AST(nested_function(depth * 4))
+    try:
+        recursive_preorder(lambda node: None, ast.root_node)
+        print(f"recursive preorder survived depth {depth * 4}")
+    except RecursionError:
+        print(f"recursive preorder hit RecursionError at depth {depth * 4}, iterative preorder:", end=" ")
+        counter, do = count()
+        ast.preorder(do)
+        print(f"{counter[0]} nodes")
+
+
+def bench_functions(n_functions: int = 300, repeat: int = 5):
+    """function extraction: reparse every function vs read captures off the file tree"""
+    code = "\n".join(synthetic_function(i) for i in range(n_functions))
+
+    def reparse():
+        ast = AST(code)
+        for func_node in ast.query(By.SExpression, FUNCTION_SEXPRESSION)["func_node"]:
+            Function.from_str(text(func_node))
+
+    print(f"[ functions ] one file, {n_functions} functions")
+    report("Function.from_str per function", measure(reparse, repeat), n_functions)
+    report("OldNewFile (single query, no reparse)", measure(lambda: OldNewFile(code, "OLD"), repeat), n_functions)
+
+
+def bench_incremental(n_functions: int = 2000, repeat: int = 3):
+    """NEW file: full OldNewFile parse vs OldNewFile.from_diff on a small patch"""
+    old_lines = "\n".join(synthetic_function(i) for i in range(n_functions)).split("\n")
+    new_lines = list(old_lines)
+    for k in (len(new_lines) // 3, len(new_lines) // 2):
+        new_lines[k] = new_lines[k] + " /* patched */"
+    new = "\n".join(new_lines)
+    diff = Diff("\n".join(line for line in difflib.unified_diff(old_lines, new_lines, lineterm="")
+                          if not line.startswith(("---", "+++"))))
+    old_file = OldNewFile("\n".join(old_lines), "OLD")
+
+    print(f"[ incremental ] {n_functions} functions, {len(diff.hunks)} hunks")
+    report("full parse of NEW", measure(lambda: OldNewFile(new, "NEW"), repeat), n_functions)
+    report("OldNewFile.from_diff", measure(lambda: OldNewFile.from_diff(old_file, diff), repeat), n_functions)
+
+
+def bench_diff(n_hunks: int = 20000, repeat: int = 3):
+    """Diff parsing throughput on a multi-MB diff"""
+    content = synthetic_diff(n_hunks)
+    size = len(content.encode("utf-8")) / 2 ** 20
+    cost = measure(lambda: Diff(content), repeat)
+    print(f"[ diff ] {n_hunks} hunks, {size:.1f} MB")
+    report("Diff(content)", cost, n_hunks)
+    print(f"{'throughput':<40} {size / cost:8.2f} MB/s")
+
+    diff = Diff(content)
+    last = diff.hunks[-1].old_end
+    report("getline for every OLD line", measure(lambda: [diff.getline(i, "OLD") for i in range(1, last + 1)]), last)
+    report("getlines batch", measure(lambda: diff.getlines(range(1, last + 1), "OLD")), last)
+    report("changed_lines bitmap", measure(lambda: diff.changed_lines(1, last, "OLD")), last)
+
+
+def bench_diff_stream(n_hunks: int = 20000):
+    """peak memory: Diff.from_file vs streaming Diff.iter_file over the same file"""
+    with tempfile.NamedTemporaryFile("w", suffix=".diff", delete=False) as f:
+        f.write(synthetic_diff(n_hunks))
+        path = f.name
+    try:
+        def consume():
+            count = 0
+            for _ in Diff.iter_file(path):
+                count += 1
+            return count
+
+        print(f"[ diff_stream ] {n_hunks} hunks, {os.path.getsize(path) / 2 ** 20:.1f} MB")
+        for name, func in (("Diff.from_file", lambda: Diff.from_file(path)), ("Diff.iter_file", consume)):
+            tracemalloc.start()
+            start = time.perf_counter()
+            func()
+            cost = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"{name:<40} total: {cost:8.4f}s   peak memory: {peak / 2 ** 20:8.1f} MB")
+    finally:
+        os.remove(path)
+
+
+def bench_text(n_functions: int = 500, repeat: int = 3):
+    """node text: node.text.decode per node vs AST.texts over code_bytes"""
+    ast = AST("\n".join(synthetic_function(i) for i in range(n_functions)))
+    nodes = ast.query(By.All)
+    print(f"[ text ] {len(nodes)} nodes")
+    report("text(nodes) (node.text.decode)", measure(lambda: text(nodes), repeat), len(nodes))
+    report("ast.texts(nodes)", measure(lambda: ast.texts(nodes), repeat), len(nodes))
+
+
+def bench_snippet(n_functions: int = 300, repeat: int = 3):
+    """By.CodeSnippet / By.StructuralSnippet on one file"""
+    ast = AST("\n".join(synthetic_function(i) for i in range(n_functions)))
+    snippet = "int ret = 0;\nret += buf[k] * a;\nif (ret > 3)\n    return helper_3(ret, buf);\nreturn ret;"
+    print(f"[ snippet ] {n_functions} functions, {len(AST(snippet).query(By.All, layer=1))} snippet statements")
+    report("By.CodeSnippet", measure(lambda: ast.query(By.CodeSnippet, snippet), repeat), n_functions)
+    report("By.StructuralSnippet", measure(lambda: ast.query(By.StructuralSnippet, snippet), repeat), n_functions)
+
+
+def bench_type_index(n_functions: int = 300, repeat: int = 3):
+    """dozens of type queries on one AST: traversal per query vs the lazily built TypeIndex"""
+    code = "\n".join(synthetic_function(i) for i in range(n_functions))
+    types = ["identifier", "call_expression", "declaration", "if_statement", "return_statement",
+             "for_statement", "subscript_expression", "number_literal"] * 4
+
+    def run(index: bool):
+        ast = AST(code, index=index)
+        for type in types:
+            ast.query(By.Type, type)
+        ast.query(By.Types, types[:8], depth=6)
+        ast.query(By.FuzzyType, "statement")
+
+    print(f"[ type_index ] {n_functions} functions, {len(types) + 2} queries per AST")
+    report("traversal per query", measure(lambda: run(False), repeat), len(types) + 2)
+    report("TypeIndex (including build)", measure(lambda: run(True), repeat), len(types) + 2)
+
+
+def bench_iquery(n_functions: int = 500, k: int = 3, repeat: int = 5):
+    """first k call sites: full query then slice vs lazy iquery"""
+    ast = AST("\n".join(synthetic_function(i) for i in range(n_functions)))
+    print(f"[ iquery ] {n_functions} functions, first {k} call_expression")
+    report("query(...)[:k]", measure(lambda: ast.query(By.Type, "call_expression")[:k], repeat), k)
+    report("islice(iquery(...), k)", measure(lambda: list(itertools.islice(ast.iquery(By.Type, "call_expression"), k)), repeat), k)
+
+
+def bench_corpus(n_items: int = 200, n_functions: int = 40, workers: int = None):
+    """process_corpus in one process vs on a process pool"""
+    workers = workers or os.cpu_count() or 1
+    with tempfile.TemporaryDirectory() as root:
+        items = []
+        for k in range(n_items):
+            old_path = os.path.join(root, f"{k}.old.c")
+            new_path = os.path.join(root, f"{k}.new.c")
+            diff_path = os.path.join(root, f"{k}.diff")
+            with open(old_path, "w") as f:
+                f.write("\n".join(synthetic_function(k * n_functions + i) for i in range(n_functions)))
+            with open(new_path, "w") as f:
+                f.write("\n".join(synthetic_function(k * n_functions + i + 1) for i in range(n_functions)))
+            with open(diff_path, "w") as f:
+                f.write(synthetic_diff(20, seed=k))
+            items.append((old_path, new_path, diff_path))
+        items.append((os.path.join(root, "missing.c"), None, None))
+
+        print(f"[ corpus ] {len(items)} items, {n_functions} functions per file")
+        results = process_corpus(items, workers=1)
+        report("process_corpus(workers=1)", measure(lambda: process_corpus(items, workers=1)), len(items))
+        report(f"process_corpus(workers={workers})", measure(lambda: process_corpus(items, workers=workers)), len(items))
+        print(f"failed items: {sum(not result.ok for result in results)}")
+
+
+def bench_cache(n_files: int = 200, n_functions: int = 40):
+    """OldNewFile on unchanged files: parse every run vs FunctionCache hits"""
+    codes = ["\n".join(synthetic_function(k * n_functions + i) for i in range(n_functions)) for k in range(n_files)]
+    print(f"[ cache ] {n_files} files, {n_functions} functions per file")
+    with tempfile.TemporaryDirectory() as root:
+        cache = FunctionCache(root)
+        report("OldNewFile (no cache)", measure(lambda: [OldNewFile(code, "OLD") for code in codes]), n_files)
+        report("OldNewFile (cold cache)", measure(lambda: [OldNewFile(code, "OLD", cache=cache) for code in codes]), n_files)
+        report("OldNewFile (warm cache)", measure(lambda: [OldNewFile(code, "OLD", cache=cache) for code in codes]), n_files)
+        print(cache.info())
+
+
+def bench_join(n_functions: int = 1000, n_hunks: int = 500, repeat: int = 3):
+    """changed functions of a patch: every function against every hunk vs join_functions' sort and sweep"""
+    old_lines = "\n".join(synthetic_function(i) for i in range(n_functions)).split("\n")
+    rng = random.Random(0)
+    new_lines = list(old_lines)
+    for k in sorted(rng.sample(range(len(old_lines)), n_hunks), reverse=True):
+        new_lines[k] += " /* x */"
+    d = "\n".join(line for line in difflib.unified_diff(old_lines, new_lines, lineterm="", n=1)
+                  if not line.startswith(("---", "+++")))
+    old, new, diff = OldNewFile("\n".join(old_lines), "OLD"), OldNewFile("\n".join(new_lines), "NEW"), Diff(d)
+
+    def nested():
+        changed = []
+        for function in new.functions:
+            lines = [line.index for hunk in diff.hunks for line in hunk.new_lines
+                     if line.type == "added" and function.range[0] + 1 <= line.index <= function.range[1] + 1]
+            if lines:
+                changed.append((function.func_name, lines))
+        return changed
+
+    print(f"[ join ] {n_functions} functions, {len(diff.hunks)} hunks")
+    report("functions x hunks", measure(nested), n_functions)
+    report("join_functions", measure(lambda: join_functions(old.functions, new.functions, diff), repeat), n_functions)
+
+
+def bench_metrics(n_functions: int = 300, n_queries: int = 2000):
+    """cost of the instrumented hot paths with metrics disabled vs enabled"""
+    ast = AST("\n".join(synthetic_function(i) for i in range(n_functions)))
+    small = AST(synthetic_function(0))
+
+    def work():
+        for _ in range(n_queries):
+            small.query(By.Type, "identifier", nest=True)
+            small.query(By.SExpression, "(identifier) @id", limit=1)
+        ast.query(By.Types, ["identifier", "call_expression"])
+
+    print(f"[ metrics ] {n_queries} x 2 small queries + 1 full traversal of {n_functions} functions")
+    metrics.disable()
+    report("metrics disabled", measure(work, 3), n_queries * 2)
+    with metrics.scope() as scoped:
+        report("metrics enabled (scope)", measure(work, 3), n_queries * 2)
+    for name, stat in sorted(scoped.snapshot()["stats"].items()):
+        print(f"{name:<40} count: {stat['count']:>8}   mean: {stat['mean']:.6g}")
+
+
+BENCHMARKS = {
+    "parser": bench_parser,
+    "preorder": bench_preorder,
+    "functions": bench_functions,
+    "incremental": bench_incremental,
+    "diff": bench_diff,
+    "diff_stream": bench_diff_stream,
+    "text": bench_text,
+    "snippet": bench_snippet,
+    "type_index": bench_type_index,
+    "iquery": bench_iquery,
+    "corpus": bench_corpus,
+    "cache": bench_cache,
+    "join": bench_join,
+    "metrics": bench_metrics,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
@@ -0,0 +1,329 @@
+import argparse
+import difflib
+import gc
+import hashlib
+import importlib.metadata
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+from astq import *
+from diff import *
+from func import *
+from oldnew import *
+
+"""
+usage
+python benchsuite.py                                   # medium corpus, results printed as a table
+python benchsuite.py --scale small --out base.json     # write machine-readable results
+python benchsuite.py --functions 3000 --depth 6 --hunks 400 --seed 7 --out head.json
+python benchsuite.py --compare base.json head.json     # exit code 1 if any case got slower than --threshold
+
+every case runs on a corpus generated from the seed, so the same arguments measure the same input on any commit;
+the corpus fingerprint in the results tells whether two result files are comparable
+"""
+
+SCALES = {
+    "small": {"functions": 200, "depth": 3, "hunks": 40},
+    "medium": {"functions": 1000, "depth": 4, "hunks": 150},
+    "large": {"functions": 5000, "depth": 5, "hunks": 600},
+}
+
+TYPES = ["int", "long", "size_t", "unsigned", "char *", "const char *", "double"]
+CALLEES = ["compute", "check", "lookup", "release", "emit", "hash_step"]
+
+
+def _statement(rng: random.Random, k: int) -> str:
+    kind = rng.randrange(6)
+    if kind == 0:
+        return f"int acc_{k} = {rng.randrange(100)};"
+    if kind == 1:
+        return f"acc = {rng.choice(CALLEES)}(acc, buf[{k}], len);"
+    if kind == 2:
+        return f"ctx->field_{k % 7} += acc * {rng.randrange(1, 9)};"
+    if kind == 3:
+        return f"// step {k}: keep acc in range"
+    if kind == 4:
+        return f"if (acc > {rng.randrange(1000)}) return acc;"
+    return f"items.push_back(static_cast<long>(acc + {k}));"
+
+
+def _block(rng: random.Random, depth: int, width: int, indent: int) -> list[str]:
+    pad = "    " * indent
+    lines = [pad + _statement(rng, rng.randrange(1000)) for _ in range(width)]
+    if depth > 0:
+        k = rng.randrange(1000)
+        head = rng.choice([f"if (acc != {k})",
+                           f"for (size_t i_{k} = 0; i_{k} < len; i_{k}++)",
+                           f"while (acc < {k} && len--)"])
+        lines.append(pad + head + " {")
+        lines.extend(_block(rng, depth - 1, width, indent + 1))
+        lines.append(pad + "}")
+        if rng.random() < 0.3:
+            lines.append(pad + "switch (acc & 3) {")
+            lines.append(pad + "case 0:")
+            lines.extend(_block(rng, 0, 1, indent + 1))
+            lines.append(pad + "    break;")
+            lines.append(pad + "default:")
+            lines.append(pad + "    acc = 0;")
+            lines.append(pad + "}")
+    return lines
+
+
+def generate_source(n_functions: int, depth: int = 4, width: int = 3, seed: int = 0) -> str:
+    """
+    a deterministic C++ translation unit: free functions, class methods and function templates,
+    each body nests control flow `depth` levels deep with `width` statements per block
+    """
+    rng = random.Random(seed)
+    lines = ["#include <vector>", "#include <cstddef>", "", "struct context { long field_0, field_1, field_2,",
+             "    field_3, field_4, field_5, field_6; };", ""]
+    i = 0
+    while i < n_functions:
+        kind = rng.random()
+        if kind < 0.15 and n_functions - i >= 2:
+            lines.append(f"class worker_{i} {{")
+            lines.append("public:")
+            for m in range(2):
+                lines.append(f"    long method_{i + m}(context *ctx, const char *buf, size_t len) {{")
+                lines.append("        long acc = 0;")
+                lines.append("        std::vector<long> items;")
+                lines.extend(_block(rng, depth, width, 2))
+                lines.append("        return acc;")
+                lines.append("    }")
+            lines.append("};")
+            i += 2
+        elif kind < 0.25:
+            lines.append("template <typename T>")
+            lines.append(f"T tmpl_{i}(T acc, context *ctx, const char *buf, size_t len)")
+            lines.append("{")
+            lines.append("    std::vector<long> items;")
+            lines.extend(_block(rng, depth, width, 1))
+            lines.append("    return acc;")
+            lines.append("}")
+            i += 1
+        else:
+            lines.append(f"static {rng.choice(TYPES)} fn_{i}(context *ctx, const char *buf, size_t len)")
+            lines.append("{")
+            lines.append("    long acc = 0;")
+            lines.append("    std::vector<long> items;")
+            lines.extend(_block(rng, depth, width, 1))
+            lines.append("    return acc;")
+            lines.append("}")
+            i += 1
+        lines.append("")
+    return "\n".join(lines)
+
+
+def generate_patch(source: str, n_hunks: int, seed: int = 0, context: int = 3) -> tuple[str, str]:
+    """
+    edit `n_hunks` spread-out places of source (change, delete or insert a statement line)
+    return: (NEW source, unified diff from source to NEW)
+    """
+    rng = random.Random(seed)
+    old_lines = source.split("\n")
+    # only statement lines inside bodies are edited, so the NEW source stays well formed
+    candidates = [k for k, line in enumerate(old_lines)
+                  if line.startswith("        ") and line.endswith(";") and not line.endswith("break;")]
+    spacing = 2 * context + 2
+    chosen = []
+    for k in sorted(rng.sample(candidates, min(len(candidates), n_hunks * 4))):
+        if not chosen or k - chosen[-1] > spacing:
+            chosen.append(k)
+        if len(chosen) == n_hunks:
+            break
+    new_lines = list(old_lines)
+    for k in reversed(chosen):
+        indent = old_lines[k][:len(old_lines[k]) - len(old_lines[k].lstrip())]
+        kind = rng.random()
+        if kind < 0.5:
+            new_lines[k] = old_lines[k].rstrip(";") + " + 1;"
+        elif kind < 0.75:
+            del new_lines[k]
+        else:
+            new_lines.insert(k + 1, indent + f"acc ^= {rng.randrange(1 << 16)};")
+    diff = "\n".join(difflib.unified_diff(old_lines, new_lines, "a/synthetic.cpp", "b/synthetic.cpp",
+                                          lineterm="", n=context))
+    return "\n".join(new_lines), diff
+
+
+class Suite:
+    """
+    the benchmark cases over one generated corpus
+    every case is timed `repeat` times, best/median/mean seconds and per item microseconds are reported
+    """
+
+    def __init__(self, functions: int, depth: int, hunks: int, seed: int = 0, repeat: int = 5):
+        self.params = {"functions": functions, "depth": depth, "hunks": hunks, "seed": seed, "repeat": repeat}
+        self.repeat = repeat
+        self.old = generate_source(functions, depth, seed=seed)
+        self.new, self.diff = generate_patch(self.old, hunks, seed=seed)
+        self.results: list[dict] = []
+
+    def fingerprint(self) -> str:
+        digest = hashlib.sha256()
+        for part in (self.old, self.new, self.diff):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()[:16]
+
+    def case(self, name: str, func, items: int, setup=None):
+        """
+        param: func: the measured call, takes setup's result when setup is given
+        param: items: what the per item time divides by (functions, nodes, hunks, lines...)
+        param: setup: untimed preparation run before every repetition
+        """
+        costs = []
+        for _ in range(self.repeat):
+            arg = setup() if setup is not None else None
+            # garbage left by the previous repetition is collected outside the timed region
+            gc.collect()
+            start = time.perf_counter()
+            func(arg) if setup is not None else func()
+            costs.append(time.perf_counter() - start)
+        result = {"name": name, "items": items, "best": min(costs), "median": statistics.median(costs),
+                  "mean": statistics.fmean(costs), "per_item_us": min(costs) / max(items, 1) * 1e6}
+        self.results.append(result)
+        return result
+
+    def run(self, progress=None) -> list[dict]:
+        old, new, diff_text = self.old, self.new, self.diff
+        ast = AST(old)
+        nodes = ast.root_node.descendant_count
+        old_functions = OldNewFile(old, "OLD").functions
+        new_functions = OldNewFile(new, "NEW").functions
+        functions = len(old_functions)
+        diff = Diff(diff_text)
+        old_rows = old.count("\n") + 1
+        new_rows = new.count("\n") + 1
+        cases = [
+            ("ast.construct", lambda: AST(old), len(old)),
+            ("ast.construct+type_index", lambda: AST(old, index=True).type_index(), len(old)),
+            ("query.Type", lambda: ast.query(By.Type, "call_expression"), nodes),
+            ("query.Type.layer", lambda: ast.query(By.Type, "function_definition", layer=1), nodes),
+            ("query.Type.nest", lambda: ast.query(By.Type, "return_statement", nest=True), nodes),
+            ("query.Types", lambda: ast.query(By.Types, ["identifier", "call_expression", "if_statement"]), nodes),
+            ("query.Types.depth", lambda: ast.query(By.Types, ["identifier", "call_expression"], depth=6), nodes),
+            ("query.Predicate", lambda: ast.query(By.Predicate, lambda n: n.child_count > 3), nodes),
+            ("query.All", lambda: ast.query(By.All), nodes),
+            ("query.All.layer", lambda: ast.query(By.All, layer=3), nodes),
+            ("query.FuzzyType", lambda: ast.query(By.FuzzyType, "statement"), nodes),
+            ("query.SExpression", lambda: ast.query(By.SExpression, "(call_expression function: (identifier) @callee)"), nodes),
+            ("query.SExpression.byte_range", lambda: ast.query(By.SExpression, "(identifier) @id",
+                                                               byte_range=(len(old) // 2, len(old) // 2 + 4096)), nodes),
+            ("query.CodeSnippet", lambda: ast.query(By.CodeSnippet, "long acc = 0;"), nodes),
+            ("query.StructuralSnippet", lambda: ast.query(By.StructuralSnippet, "long acc=0 ;"), nodes),
+            ("matches.function", lambda: ast.matches(FUNCTION_SEXPRESSION), functions),
+            ("iquery.first10", lambda: list(itertools.islice(ast.iquery(By.Type, "call_expression"), 10)), 10),
+            ("oldnew.extract", lambda: OldNewFile(old, "OLD"), functions),
+            ("oldnew.from_diff", (lambda file: OldNewFile.from_diff(file, diff)), functions,
+             lambda: OldNewFile(old, "OLD")),
+            ("oldnew.join", lambda: join_functions(old_functions, new_functions, diff), functions),
+            ("diff.parse", lambda: Diff(diff_text), len(diff.hunks)),
+            ("diff.parse+lines", lambda: [hunk.new_lines for hunk in Diff(diff_text).hunks], len(diff.hunks)),
+            ("diff.getline.OLD", lambda: diff.getlines(range(1, old_rows + 1), "OLD"), old_rows),
+            ("diff.getline.NEW", lambda: diff.getlines(range(1, new_rows + 1), "NEW"), new_rows),
+            ("diff.changed_lines", lambda: diff.changed_lines(1, new_rows, "NEW"), new_rows),
+        ]
+        for name, func, items, *setup in cases:
+            result = self.case(name, func, items, *setup)
+            if progress is not None:
+                progress(result)
+        return self.results
+
+    def report(self) -> dict:
+        return {"meta": environment(), "params": self.params, "corpus": {
+                    "fingerprint": self.fingerprint(), "old_bytes": len(self.old), "new_bytes": len(self.new),
+                    "diff_bytes": len(self.diff)},
+                "results": self.results}
+
+
+def environment() -> dict:
+    def version(name: str) -> str:
+        try:
+            return importlib.metadata.version(name)
+        except importlib.metadata.PackageNotFoundError:
+            return "unknown"
+    def git(*args: str) -> str:
+        return subprocess.run(["git", *args], capture_output=True, text=True, timeout=10,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    try:
+        commit = git("rev-parse", "--short", "HEAD") or None
+        if commit is not None and git("status", "--porcelain", "--untracked-files=no"):
+            commit += "-dirty"
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {"commit": commit, "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(), "platform": platform.platform(),
+            "tree_sitter": version("tree-sitter"), "grammar": registry.grammar_version("cpp")}
+
+
+def print_result(result: dict):
+    print(f"{result['name']:<32} best: {result['best']:9.5f}s   median: {result['median']:9.5f}s   "
+          f"per item: {result['per_item_us']:10.3f}us")
+
+
+def compare(base: dict, head: dict, threshold: float = 1.10) -> list[tuple[str, float]]:
+    """
+    best time of every case in head against base
+    return: the cases slower than threshold times base, with their ratio
+    """
+    if base["corpus"]["fingerprint"] != head["corpus"]["fingerprint"]:
+        print("warning: the two runs measured different corpora, ratios are not comparable", file=sys.stderr)
+    base_results = {result["name"]: result for result in base["results"]}
+    regressions = []
+    print(f"{'case':<32} {'base':>10} {'head':>10} {'ratio':>7}   ({base['meta']['commit']} -> {head['meta']['commit']})")
+    for result in head["results"]:
+        before = base_results.get(result["name"])
+        if before is None:
+            print(f"{result['name']:<32} {'-':>10} {result['best']:10.5f} {'new':>7}")
+            continue
+        ratio = result["best"] / before["best"] if before["best"] else float("inf")
+        flag = "  <- slower" if ratio > threshold else ""
+        print(f"{result['name']:<32} {before['best']:10.5f} {result['best']:10.5f} {ratio:7.2f}{flag}")
+        if ratio > threshold:
+            regressions.append((result["name"], ratio))
+    return regressions
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="reproducible benchmarks over a generated C++/diff corpus")
+    parser.add_argument("--scale", choices=list(SCALES), default="medium")
+    parser.add_argument("--functions", type=int, help="functions in the generated source, overrides --scale")
+    parser.add_argument("--depth", type=int, help="control flow nesting depth of the function bodies")
+    parser.add_argument("--hunks", type=int, help="hunks in the generated diff")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--out", help="write the results as json to this path")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "HEAD"), help="compare two result files")
+    parser.add_argument("--threshold", type=float, default=1.10, help="slowdown ratio reported as a regression")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            base = json.load(f)
+        with open(args.compare[1]) as f:
+            head = json.load(f)
+        return 1 if compare(base, head, args.threshold) else 0
+
+    params = dict(SCALES[args.scale])
+    for key in ("functions", "depth", "hunks"):
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+    suite = Suite(seed=args.seed, repeat=args.repeat, **params)
+    print(f"[ suite ] {params} seed={args.seed} repeat={args.repeat} corpus={suite.fingerprint()}")
+    suite.run(progress=print_result)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(suite.report(), f, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
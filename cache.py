@@ -0,0 +1,194 @@
+import fcntl
+import hashlib
+import importlib.metadata
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from astq import *
+from func import *
+from metrics import *
+
+"""
+use case
+cache = FunctionCache("~/.cache/astq", max_bytes=256 * 1024 * 1024)
+file = OldNewFile(code, "OLD", cache=cache)  # hit: no tree-sitter parse, nodes are resolved on first access
+cache.info()
+"""
+
+# bump when the record layout or the extraction logic changes
+CACHE_VERSION = 1
+# eviction goes down to this fraction of max_bytes, so the directory is rescanned once per ~10% of churn
+# instead of on every put once the cache is full
+EVICT_TO = 0.9
+# holds the running total of the entry sizes, shared by every FunctionCache (and process) on the directory;
+# updates happen under an flock on it, so the bound holds for the directory and not per instance
+SIZE_FILE = "size"
+SIZE_WIDTH = 20
+
+
+def _distribution_version(name: str) -> str:
+    try:
+        return importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        return "unknown"
+
+
+class FunctionCache:
+    """
+    on-disk cache of extracted functions, keyed by a hash of the file bytes, the grammar and the tree-sitter version
+    one json file per entry, written atomically; beyond max_bytes the least recently used entries are evicted
+    down to EVICT_TO * max_bytes
+    the size bound is kept for the directory, instances in other threads or processes on it share the running total
+    interface:
+        key(code_bytes)
+        get(code_bytes)
+        put(code_bytes, range, functions)
+        info()
+        clear()
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 256 * 1024 * 1024, lang: str = "cpp"):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        self.lang = lang
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        # everything that can change the extracted records goes into the key
+        self._salt = "\0".join([str(CACHE_VERSION), lang, registry.grammar_version(lang),
+                                _distribution_version("tree-sitter"), FUNCTION_SEXPRESSION]).encode("utf-8")
+
+    def key(self, code_bytes: bytes) -> str:
+        digest = hashlib.sha256(self._salt)
+        digest.update(b"\0")
+        digest.update(code_bytes)
+        return digest.hexdigest()
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, code_bytes: bytes) -> tuple[tuple[int, int], list[FunctionRecord]] or None:
+        """
+        return: (file range, function records) or None on a miss
+        """
+        path = self.__path(self.key(code_bytes))
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            if metrics.enabled:
+                metrics.count("function_cache.miss")
+            return None
+        with self._lock:
+            self.hits += 1
+        if metrics.enabled:
+            metrics.count("function_cache.hit")
+        return tuple(entry["range"]), [FunctionRecord(**record) for record in entry["functions"]]
+
+    def put(self, code_bytes: bytes, range: tuple[int, int], functions: list[FunctionRecord]):
+        # records only hold str/int/tuple fields, a shallow vars() is enough and much cheaper than asdict
+        data = json.dumps({"range": range, "functions": [vars(record) for record in functions]},
+                          separators=(",", ":"))
+        path = self.__path(self.key(code_bytes))
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(data)
+                size = f.tell()
+            with self.__size() as (total, update):
+                # another instance may have put the same file already, the replaced entry no longer counts
+                try:
+                    size -= os.stat(path).st_size
+                except OSError:
+                    pass
+                os.replace(tmp_path, path)
+                total += size
+                if total > self.max_bytes:
+                    total = self.__evict()
+                update(total)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @contextmanager
+    def __size(self):
+        """
+        lock the size file of the directory and yield (total, update), update(total) stores a new total
+        a missing or unreadable size file is rebuilt from a scan of the directory
+        """
+        fd = os.open(os.path.join(self.directory, SIZE_FILE), os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                total = int(os.pread(fd, SIZE_WIDTH, 0))
+            except ValueError:
+                total = sum(size for _, size, _ in self.__entries())
+
+            def update(value: int):
+                # fixed width, so the file never needs truncating
+                os.pwrite(fd, f"{value:{SIZE_WIDTH}d}".encode("ascii"), 0)
+
+            yield total, update
+        finally:
+            os.close(fd)
+
+    def __entries(self) -> list[tuple[float, int, str]]:
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def __evict(self) -> int:
+        """
+        called with the size file locked, return: total size of the entries left
+        """
+        entries = self.__entries()
+        total = sum(size for _, size, _ in entries)
+        # the running total drifts when entries are removed by hand, the scan is authoritative
+        if total <= self.max_bytes:
+            return total
+        target = self.max_bytes * EVICT_TO
+        # mtime is refreshed on every hit, so the oldest mtime is the least recently used entry
+        entries.sort()
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        return total
+
+    def info(self) -> dict:
+        entries = self.__entries()
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(entries),
+                    "bytes": sum(size for _, size, _ in entries), "max_bytes": self.max_bytes}
+
+    def clear(self):
+        with self.__size() as (_, update):
+            for _, _, path in self.__entries():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            update(0)
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
@@ -0,0 +1,128 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Iterable, Literal
+
+from astq import *
+from cache import *
+from diff import *
+from func import *
+from oldnew import *
+
+"""
+use case
+items = [("old/a.c", "new/a.c", "a.c.diff"), ("old/b.c", None, None)]
+for result in process_corpus(items, workers=8):
+    if not result.ok:
+        print(result.item, result.error)
+        continue
+    for function in result.old.functions:
+        function.func_name, function.range
+    result.heads
+    for change in result.changes:
+        change.func_name, change.old_lines, change.new_lines
+"""
+
+
+@dataclass
+class FileRecord:
+    """
+    picklable summary of an OldNewFile
+    """
+    type: Literal["OLD", "NEW"]
+    filename: str or None
+    range: tuple[int, int]
+    functions: list[FunctionRecord]
+
+    @classmethod
+    def from_file(cls, file: OldNewFile):
+        return cls(type=file.type,
+                   filename=file.filename,
+                   range=file.range,
+                   functions=[function.to_record() for function in file.functions])
+
+
+@dataclass
+class CorpusResult:
+    """
+    the result of one (OLD file, NEW file, diff) item, error is set instead of raising when the item failed
+    changes pairs the functions the diff touched, only when all three are given
+    """
+    index: int
+    item: tuple[str or None, str or None, str or None]
+    old: FileRecord or None = None
+    new: FileRecord or None = None
+    heads: list[Head] = field(default_factory=list)
+    changes: list[FunctionChange] = field(default_factory=list)
+    error: str or None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def process_item(index: int, item: tuple[str or None, str or None, str or None],
+                 cache: FunctionCache = None) -> CorpusResult:
+    """
+    parse one (OLD path, NEW path, diff path) triple, any of them may be None
+    param: cache: files already in the cache are not parsed again
+    """
+    result = CorpusResult(index=index, item=tuple(item))
+    try:
+        old_path, new_path, diff_path = item
+        if old_path is not None:
+            with open(old_path, "r") as f:
+                result.old = FileRecord.from_file(OldNewFile(f.read(), "OLD", filename=old_path, cache=cache))
+        if new_path is not None:
+            with open(new_path, "r") as f:
+                result.new = FileRecord.from_file(OldNewFile(f.read(), "NEW", filename=new_path, cache=cache))
+        if diff_path is not None:
+            diff = Diff.from_file(diff_path)
+            result.heads = diff.heads
+            if result.old is not None and result.new is not None:
+                result.changes = join_functions(result.old.functions, result.new.functions, diff)
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    return result
+
+
+# the FunctionCache of the current (worker) process, set up by _warm_worker
+_cache: FunctionCache or None = None
+
+
+def _process_indexed(indexed_item):
+    return process_item(*indexed_item, cache=_cache)
+
+
+def _warm_worker(lang: str = "cpp", cache_dir: str = None, cache_bytes: int = None):
+    # build the worker's parser and compile the function query once, before the first item arrives
+    global _cache
+    registry.parser(lang)
+    query_cache.get(registry.language(lang), FUNCTION_SEXPRESSION)
+    if cache_dir is None:
+        _cache = None
+    elif cache_bytes is None:
+        _cache = FunctionCache(cache_dir, lang=lang)
+    else:
+        _cache = FunctionCache(cache_dir, max_bytes=cache_bytes, lang=lang)
+
+
+def process_corpus(items: Iterable[tuple[str or None, str or None, str or None]], workers: int = None,
+                   chunksize: int = 8, cache_dir: str = None, cache_bytes: int = None) -> list[CorpusResult]:
+    """
+    parse a corpus of (OLD path, NEW path, diff path) triples on a process pool
+    param: items: the triples, any path may be None
+    param: workers: number of processes, defaults to os.cpu_count(); 1 runs in the current process
+    param: chunksize: items handed to a worker at a time
+    param: cache_dir: directory of a FunctionCache shared by the workers, None disables caching
+    param: cache_bytes: size bound of that cache, defaults to FunctionCache's
+    return: one CorpusResult per item, in input order, failed items carry an error instead of aborting the batch
+    """
+    indexed = list(enumerate(items))
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        _warm_worker("cpp", cache_dir, cache_bytes)
+        return [_process_indexed(indexed_item) for indexed_item in indexed]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_warm_worker,
+                             initargs=("cpp", cache_dir, cache_bytes)) as pool:
+        return list(pool.map(_process_indexed, indexed, chunksize=chunksize))
@@ -1,6 +1,12 @@
-from typing import Literal
+from typing import Literal, Iterable, Iterator
+from array import array
+from bisect import bisect_right
+from collections.abc import Sequence
 import re
 from dataclasses import dataclass
+from functools import cached_property
+
+from metrics import *
 
 """
 use case
@@ -18,8 +24,21 @@ for hunk in diff.hunks:
         line.line_content
 line = diff.getline(47, "OLD")
 hunk = diff.gethunk(47, "OLD")
+lines = diff.getlines(range(40, 60), "NEW")
+bitmap = diff.changed_lines(40, 60, "NEW")
+added = diff.changed_indices("NEW")
+for section in Diff.iter_file("path/to/your/diff"):
+    if isinstance(section, FileHead):
+        section.new_path
+    else:
+        section.old_start
 diff.getoldline(47)
 diff.getnewhunk(47)
+patchset = PatchSet.from_file("path/to/your/commit.patch")
+for file in patchset:
+    file.new_path
+    file.getline(47, "NEW")
+patchset["src/file.c"].gethunk(47, "OLD")
 print(line)
 """
 
@@ -32,6 +51,8 @@ class Line:
         index
         line_content
     """
+    __slots__ = ("type", "index", "line_content")
+
     def __init__(self, type: Literal["added", "removed", "context"], index: int, line_content: str):
         self.type: Literal["added", "removed", "context"] = type
         self.index: int = index
@@ -49,7 +70,11 @@ class Line:
 
 
 
-@dataclass
+# "@@ -a,len +b,len @@", a missing ",len" means a length of 1
+HEAD_REGEX = re.compile(r"@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+@dataclass(slots=True)
 class Head:
     old_start: int
     old_len: int
@@ -58,6 +83,60 @@ class Head:
     new_len: int
     new_end: int
 
+    @classmethod
+    def from_match(cls, match: re.Match):
+        old_start = int(match.group(1))
+        old_len = int(match.group(2)) if match.group(2) is not None else 1
+        new_start = int(match.group(3))
+        new_len = int(match.group(4)) if match.group(4) is not None else 1
+        return cls(old_start=old_start,
+                   old_len=old_len,
+                   old_end=old_start+old_len-1,
+                   new_start=new_start,
+                   new_len=new_len,
+                   new_end=new_start+new_len-1
+               )
+
+
+
+# type codes of the per-hunk line arrays
+CONTEXT, REMOVED, ADDED, MARKER = 0, 1, 2, 3
+LINE_TYPES = ("context", "removed", "added")
+
+
+
+class Lines(Sequence):
+    """
+    read-only list of one side (old/new) of a hunk, Line objects are built on access from the hunk's arrays
+    """
+    __slots__ = ("hunk", "rows", "start")
+
+    def __init__(self, hunk: "Hunk", rows: array, start: int):
+        self.hunk = hunk
+        self.rows = rows
+        self.start = start
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self.rows)))]
+        if i < 0:
+            i += len(self.rows)
+        if not 0 <= i < len(self.rows):
+            raise IndexError("line index out of range")
+        return self.hunk._line(self.rows[i], self.start + i)
+
+    def __iter__(self):
+        line = self.hunk._line
+        start = self.start
+        for i, row in enumerate(self.rows):
+            yield line(row, start + i)
+
+    def __repr__(self):
+        return repr(list(self))
+
 
 
 class Hunk:
@@ -70,16 +149,20 @@ class Hunk:
         content_wo_head
         old_lines(iterable)
         new_lines(iterable)
+    only the head is parsed when the hunk is built, content, the line arrays and the fields above
+    are computed on first access and cached
+    lines are stored as parallel arrays over the body lines of content (type code, start/end offset),
+    each side keeps the body rows it is made of, Line objects are only created when accessed
     """
-    def __init__(self, hunk_content: str):
-        self.head: Head = self.__parse_head(hunk_content)
-        self.content = hunk_content
-        self.content_wo_head = self.__parse_content_wo_head(hunk_content)
-        self.old_lines: list[Line] = self.__parse_old_lines(hunk_content)
-        self.new_lines: list[Line] = self.__parse_new_lines(hunk_content)
-        self.old_text = self.__parse_old_text()
-        self.new_text = self.__parse_new_text()
-
+    def __init__(self, hunk_content: str or None, lines: list[str] = None, head: Head = None):
+        if hunk_content is not None:
+            self.content = hunk_content
+        elif lines is None:
+            raise ValueError("a hunk needs its content or its lines")
+        self.__lines = lines
+        if head is None:
+            head = self.__parse_head(lines[0] if lines is not None else hunk_content.partition("\n")[0])
+        self.head: Head = head
 
         self.old_start: int = self.head.old_start
         self.old_len: int = self.head.old_len
@@ -88,97 +171,150 @@ class Hunk:
         self.new_len: int = self.head.new_len
         self.new_end: int = self.head.new_end
 
-    def __parse_head(self, hunk_content):
-        diff_head_regex = re.compile(r"@@ -(\d+),(\d+) \+(\d+),(\d+) @@")
-        head_line = hunk_content.split("\n")[0]
-        match = diff_head_regex.search(head_line)
-        if match:
-            old_start = int(match.group(1))
-            old_len = int(match.group(2))
-            new_start = int(match.group(3))
-            new_len = int(match.group(4))
-            return Head(old_start=old_start,
-                        old_len=old_len,
-                        old_end=old_start+old_len-1,
-                        new_start=new_start,
-                        new_len=new_len,
-                        new_end=new_start+new_len-1
-                   )
-        else:
-            raise Exception
-
-    def __parse_content_wo_head(self, hunk_content):
-        content = []
-        diff_head_regex = re.compile(r"@@ -(\d+),(\d+) \+(\d+),(\d+) @@")
-        for line in hunk_content.split("\n"):
-            if not diff_head_regex.search(line):
-                content.append(line)
-        return "\n".join(content)
-
-
-    def __parse_old_lines(self, hunk_content):
-        hunk_content_wo_head = self.__parse_content_wo_head(hunk_content)
-
-        # loop var
-        lines = []
-        old_count = self.head.old_start
-        for line in hunk_content_wo_head.split("\n"):
-            if line.startswith("-"):
-                lines.append(Line(
-                    type="removed",
-                    line_content=line[1:],  # 去掉减号
-                    index=old_count,
-                ))
-                old_count += 1
-            elif line.startswith("+"):
-                pass
-            else:
-                lines.append(Line(
-                    type="context",
-                    line_content=line,
-                    index=old_count,
-                ))
-                old_count += 1
-        return lines
-
-    def __parse_new_lines(self, hunk_content):
-        hunk_content_wo_head = self.__parse_content_wo_head(hunk_content)
-
-        # loop var
-        lines = []
-        new_count = self.head.new_start
-        for line in hunk_content_wo_head.split("\n"):
-            if line.startswith("-"):
-                pass
-            elif line.startswith("+"):
-                lines.append(Line(
-                    type="added",
-                    line_content=line[1:],  # 去掉加号
-                    index=new_count,
-                ))
-                new_count += 1
-            else:
-                lines.append(Line(
-                    type="context",
-                    line_content=line,
-                    index=new_count,
-                ))
-                new_count += 1
-        return lines
+    @classmethod
+    def from_lines(cls, lines: list[str], head: Head = None):
+        """build a hunk from its already split lines, the first one being the @@ head"""
+        return cls(None, lines, head)
+
+    @cached_property
+    def content(self) -> str:
+        return "\n".join(self.__lines)
+
+    @cached_property
+    def content_wo_head(self) -> str:
+        return self.content.partition("\n")[2]
+
+    @cached_property
+    def old_lines(self) -> Lines:
+        return Lines(self, self._old_rows, self.head.old_start)
+
+    @cached_property
+    def new_lines(self) -> Lines:
+        return Lines(self, self._new_rows, self.head.new_start)
+
+    @cached_property
+    def old_text(self) -> str:
+        return "\n".join([self._content(row) for row in self._old_rows])
 
-    def __parse_old_text(self):
-        text = []
-        for line in self.old_lines:
-            text.append(line.line_content)
-        return "\n".join(text)
+    @cached_property
+    def new_text(self) -> str:
+        return "\n".join([self._content(row) for row in self._new_rows])
 
-    def __parse_new_text(self):
-        text = []
-        for line in self.new_lines:
-            text.append(line.line_content)
-        return "\n".join(text)
+    # the line arrays are filled together by the first access to any of them
+    @cached_property
+    def _types(self) -> array:
+        return self.__parse_lines()[0]
 
+    @cached_property
+    def _starts(self) -> array:
+        return self.__parse_lines()[1]
 
+    @cached_property
+    def _ends(self) -> array:
+        return self.__parse_lines()[2]
+
+    @cached_property
+    def _old_rows(self) -> array:
+        return self.__parse_lines()[3]
+
+    @cached_property
+    def _new_rows(self) -> array:
+        return self.__parse_lines()[4]
+
+    def __parse_head(self, head_line):
+        match = HEAD_REGEX.search(head_line)
+        if match:
+            return Head.from_match(match)
+        else:
+            raise ValueError(f"not a hunk head: {head_line!r}")
+
+    def __parse_lines(self) -> tuple[array, array, array, array, array]:
+        # one sweep over the lines fills both sides, context lines go to both
+        content = self.content
+        if self.__lines is not None:
+            offset, body = len(self.__lines[0]) + 1, self.__lines[1:] or [""]
+        else:
+            head_end = content.find("\n")
+            offset, body = (head_end + 1, content[head_end + 1:].split("\n")) if head_end != -1 else (len(content) + 1, [""])
+        # content is cached from now on, the split lines are no longer needed
+        self.__lines = None
+        if metrics.enabled:
+            metrics.count("hunk.parse_lines")
+        types = array("b")
+        starts = array("i")
+        ends = array("i")
+        old_rows = array("i")
+        new_rows = array("i")
+        for row, line in enumerate(body):
+            starts.append(offset)
+            offset += len(line)
+            ends.append(offset)
+            offset += 1
+            if line.startswith("\\"):
+                # "\ No newline at end of file" is a marker, not a line of either side
+                types.append(MARKER)
+            elif line.startswith("-"):
+                types.append(REMOVED)
+                old_rows.append(row)
+            elif line.startswith("+"):
+                types.append(ADDED)
+                new_rows.append(row)
+            else:
+                types.append(CONTEXT)
+                old_rows.append(row)
+                new_rows.append(row)
+        self.__dict__.update(_types=types, _starts=starts, _ends=ends, _old_rows=old_rows, _new_rows=new_rows)
+        return types, starts, ends, old_rows, new_rows
+
+    def _content(self, row: int) -> str:
+        # context lines keep their leading space, removed/added lines drop their -/+
+        start = self._starts[row] if self._types[row] == CONTEXT else self._starts[row] + 1
+        return self.content[start:self._ends[row]]
+
+    def changed_indices(self, oldnew: Literal["OLD", "NEW"]) -> list[int]:
+        """ascending line numbers of the removed (OLD) / added (NEW) lines of this hunk"""
+        if oldnew == "OLD":
+            rows, start, changed = self._old_rows, self.head.old_start, REMOVED
+        else:
+            rows, start, changed = self._new_rows, self.head.new_start, ADDED
+        types = self._types
+        return [start + k for k, row in enumerate(rows) if types[row] == changed]
+
+    def _line(self, row: int, index: int) -> Line:
+        return Line(type=LINE_TYPES[self._types[row]], index=index, line_content=self._content(row))
+
+    def changes(self) -> list[tuple[int, int, str]]:
+        """
+        contiguous runs of removed/added lines, context lines are left out
+        return: [(old_index, old_count, new_text)], the run replaces old_count OLD lines starting at
+                old_index with new_text (added lines joined, each ending in "\\n")
+        """
+        changes = []
+        # a hunk without OLD lines ("-5,0") inserts after its old_start line
+        old_count = self.head.old_start if self.head.old_len else self.head.old_start + 1
+        run_start, run_len, run_lines = None, 0, []
+        for row, type in enumerate(self._types):
+            if type == MARKER:
+                # "\ No newline at end of file" refers to the line right before it
+                if run_lines and run_lines[-1].endswith("\n"):
+                    run_lines[-1] = run_lines[-1][:-1]
+                continue
+            if type != CONTEXT:
+                if run_start is None:
+                    run_start, run_len, run_lines = old_count, 0, []
+                if type == REMOVED:
+                    run_len += 1
+                    old_count += 1
+                else:
+                    run_lines.append(self._content(row) + "\n")
+                continue
+            if run_start is not None:
+                changes.append((run_start, run_len, "".join(run_lines)))
+                run_start = None
+            old_count += 1
+        if run_start is not None:
+            changes.append((run_start, run_len, "".join(run_lines)))
+        return changes
 
     def __str__(self):
         dec = "=" * 20
@@ -197,6 +333,111 @@ class Hunk:
 
 
 
+@dataclass
+class FileHead:
+    """
+    the header of one file section in a multi-file diff
+    interface:
+        old_path, new_path (None for /dev/null)
+        lines (diff --git, index, ---, +++ ... lines as they appear)
+    """
+    old_path: str or None
+    new_path: str or None
+    lines: list[str]
+
+    @classmethod
+    def from_lines(cls, lines: list[str]):
+        old_path = new_path = None
+        for line in lines:
+            if line.startswith("diff --git "):
+                paths = line[len("diff --git "):]
+                if " b/" in paths:
+                    old_path, new_path = paths.split(" b/", 1)
+                    old_path = cls.__strip_path(old_path)
+                    new_path = cls.__strip_path("b/" + new_path)
+            elif line.startswith("--- "):
+                old_path = cls.__strip_path(line[4:])
+            elif line.startswith("+++ "):
+                new_path = cls.__strip_path(line[4:])
+        return cls(old_path=old_path, new_path=new_path, lines=lines)
+
+    @staticmethod
+    def __strip_path(path: str) -> str or None:
+        # "a/src/x.c\t2015-01-01 00:00:00" -> "src/x.c"
+        path = path.split("\t", 1)[0].strip()
+        if path == "/dev/null":
+            return None
+        if path.startswith(("a/", "b/")):
+            path = path[2:]
+        return path
+
+
+
+def iter_sections(lines: Iterable[str]) -> Iterator[FileHead or Hunk]:
+    """
+    stream a unified diff line by line, yielding a FileHead for every file header block
+    (diff --git / --- / +++) and a Hunk for every hunk, only the running hunk is kept in memory
+    a hunk ends once its head's old_len/new_len lines are consumed (plus a trailing "\\ No newline" marker)
+    a hunk head must start at column 0 and follow a file header, another hunk or the start of the stream,
+    so "@@ -a +b @@" quoted in a commit message is not taken for a hunk
+    """
+    header: list[str] = []
+    hunk_lines: list[str] = []
+    head = None
+    old_left = new_left = 0
+
+    def is_file_header(block: list[str]) -> bool:
+        return any(line.startswith(("diff --git ", "--- ", "+++ ")) for line in block)
+
+    for line in lines:
+        if head is not None:
+            if old_left > 0 or new_left > 0:
+                if line.startswith("\\"):
+                    hunk_lines.append(line)
+                    continue
+                if line.startswith("-") and old_left > 0:
+                    old_left -= 1
+                    hunk_lines.append(line)
+                    continue
+                if line.startswith("+") and new_left > 0:
+                    new_left -= 1
+                    hunk_lines.append(line)
+                    continue
+                if (line == "" or line.startswith(" ")) and old_left > 0 and new_left > 0:
+                    old_left -= 1
+                    new_left -= 1
+                    hunk_lines.append(line)
+                    continue
+            elif line.startswith("\\"):
+                hunk_lines.append(line)
+                continue
+            # the running hunk is complete (or truncated), hand it out and treat the line as a new one
+            yield Hunk.from_lines(hunk_lines, head)
+            head = None
+
+        match = line.startswith("@@ -") and HEAD_REGEX.match(line)
+        if match and (is_file_header(header) or not any(header_line.strip() for header_line in header)):
+            if is_file_header(header):
+                yield FileHead.from_lines(header)
+            header = []
+            head = Head.from_match(match)
+            hunk_lines = [line]
+            old_left, new_left = head.old_len, head.new_len
+        elif line.startswith("diff --git "):
+            # anything before the first "diff --git" (mail headers, commit message) is not part of the file header
+            if is_file_header(header):
+                yield FileHead.from_lines(header)
+            header = [line]
+        else:
+            header.append(line)
+
+    if head is not None:
+        yield Hunk.from_lines(hunk_lines, head)
+    elif is_file_header(header):
+        yield FileHead.from_lines(header)
+
+
+
 class Diff:
     """
     a diff file
@@ -205,53 +446,46 @@ class Diff:
         heads(iterable)
     """
     def __init__(self, diff_content):
-       self.hunks: list[Hunk] = self.__parse_hunks(diff_content)
-       self.heads: list[Head] = self.__parse_heads(diff_content)
+       if not metrics.enabled:
+           self._set_hunks(self.__parse_hunks(diff_content))
+           return
+       # metrics: time of every Diff parse under "diff.parse", hunks under "diff.hunks"
+       with metrics.timing("diff.parse"):
+           self._set_hunks(self.__parse_hunks(diff_content))
+       metrics.count("diff.hunks", len(self.hunks))
+
+    def _set_hunks(self, hunks: list[Hunk]):
+       self.hunks: list[Hunk] = hunks
+       self.heads: list[Head] = [hunk.head for hunk in hunks]
+       # interval index: hunks sorted by start on each side, looked up by bisection
+       self.__old_index = sorted(hunks, key=lambda hunk: hunk.old_start)
+       self.__old_starts = [hunk.old_start for hunk in self.__old_index]
+       self.__new_index = sorted(hunks, key=lambda hunk: hunk.new_start)
+       self.__new_starts = [hunk.new_start for hunk in self.__new_index]
 
     def __parse_hunks(self, diff_content):
-        # loop: find all diff_heads' index
-        # loop vars
-        diff_head_regex = re.compile(r"@@ -\d+,\d+ \+\d+,\d+ @@")
-        line_indexes = []
-        lines = diff_content.split("\n")
-        for i, line in enumerate(lines):
-            if diff_head_regex.search(line):
-                line_indexes.append(i)
-        # loop return:
-        # line_indexes: list[int]
-        # lines: list of diff lines
-
-        # loop: split hunk by indexes
-        # loop vars
-        chunks = []
-        right = len(diff_content.split("\n"))
-        for index in reversed(line_indexes):
-            chunks.append(Hunk("\n".join(lines[index:right])))
-            right = index
-        return chunks
-
-
-    def __parse_heads(self, diff_content):
-        diff_head_regex = re.compile(r"@@ -(\d+),(\d+) \+(\d+),(\d+) @@")
-        res = re.findall(diff_head_regex, diff_content)
-
-        # loop var
-        heads = []
-        for old_start, old_len, new_start, new_len in res:
-            old_start = int(old_start)
-            old_len = int(old_len)
-            new_start = int(new_start)
-            new_len = int(new_len)
-            heads.append(
-                Head(old_start=old_start,
-                     old_len=old_len,
-                     old_end=old_start+old_len-1,
-                     new_start=new_start,
-                     new_len=new_len,
-                     new_end=new_start+new_len-1
-                )
-            )
-        return heads
+        # only the @@ head lines are looked at: each head line opens a hunk that runs until the next one,
+        # the hunk bodies are sliced out of diff_content untouched and parsed on first access
+        hunks = []
+        start = None
+        head = None
+        position = diff_content.find("@@ -")
+        while position != -1:
+            match = HEAD_REGEX.match(diff_content, position)
+            if match is None:
+                position = diff_content.find("@@ -", position + 1)
+                continue
+            line_start = diff_content.rfind("\n", 0, position) + 1
+            if start is not None:
+                hunks.append(Hunk(diff_content[start:line_start - 1], head=head))
+            start = line_start
+            head = Head.from_match(match)
+            # a line opens at most one hunk
+            line_end = diff_content.find("\n", match.end())
+            position = diff_content.find("@@ -", line_end) if line_end != -1 else -1
+        if start is not None:
+            hunks.append(Hunk(diff_content[start:], head=head))
+        return hunks
 
 
 
@@ -264,6 +498,22 @@ class Diff:
     def from_str(cls, content: str):
         return cls(content)
 
+    @classmethod
+    def from_hunks(cls, hunks: list[Hunk]):
+        """hunks in file order"""
+        diff = cls.__new__(cls)
+        diff._set_hunks(hunks)
+        return diff
+
+    @staticmethod
+    def iter_file(path: str) -> Iterator[FileHead or Hunk]:
+        """
+        read a (possibly huge, multi-file) diff line by line and yield its FileHeads and Hunks one at a time,
+        memory stays bounded by the largest hunk instead of the whole file
+        """
+        with open(path, "r") as diff:
+            yield from iter_sections(line[:-1] if line.endswith("\n") else line for line in diff)
+
     def __str__(self):
         return ("$&"*10+"   DIFF FILE   "+"$&"*10 + "\n"
                 +f"{' '*20}   {str(len(self.heads)): ^3} HUNKS   {' '*20}" + "\n"
@@ -277,14 +527,14 @@ class Diff:
                 return self.getnewhunk(index)
 
     def getoldhunk(self, index) -> Hunk or None:
-        for hunk in self.hunks:
-            if hunk.old_start <= index <= hunk.old_end:
-                return hunk
+        i = bisect_right(self.__old_starts, index) - 1
+        if i >= 0 and index <= self.__old_index[i].old_end:
+            return self.__old_index[i]
 
     def getnewhunk(self, index) -> Hunk or None:
-        for hunk in self.hunks:
-            if hunk.new_start <= index <= hunk.new_end:
-                return hunk
+        i = bisect_right(self.__new_starts, index) - 1
+        if i >= 0 and index <= self.__new_index[i].new_end:
+            return self.__new_index[i]
 
     def getline(self, index: int, oldnew: Literal["OLD", "NEW"]) -> Line or None:
         match oldnew:
@@ -295,19 +545,151 @@ class Diff:
                 return self.getnewline(index)
 
     def getoldline(self, index) -> Line or None:
-        for hunk in self.hunks:
-            if hunk.old_start <= index <= hunk.old_end:
-                return hunk.old_lines[index - hunk.old_start]
+        hunk = self.getoldhunk(index)
+        if hunk is not None:
+            return hunk.old_lines[index - hunk.old_start]
 
     def getnewline(self, index) -> Line or None:
-        for hunk in self.hunks:
-            if hunk.new_start <= index <= hunk.new_end:
-                return hunk.new_lines[index - hunk.new_start]
+        hunk = self.getnewhunk(index)
+        if hunk is not None:
+            return hunk.new_lines[index - hunk.new_start]
+
+    def getlines(self, indices: Iterable[int], oldnew: Literal["OLD", "NEW"]) -> list[Line or None]:
+        """batch getline, one Line (or None) per index"""
+        getline = self.getoldline if oldnew == "OLD" else self.getnewline
+        return [getline(index) for index in indices]
+
+    def changed_indices(self, oldnew: Literal["OLD", "NEW"]) -> list[int]:
+        """ascending line numbers of every removed (OLD) / added (NEW) line of the diff"""
+        indices = []
+        for hunk in (self.__old_index if oldnew == "OLD" else self.__new_index):
+            indices.extend(hunk.changed_indices(oldnew))
+        return indices
+
+    def changed_lines(self, start: int, end: int, oldnew: Literal["OLD", "NEW"]) -> bytearray:
+        """
+        bitmap of the lines start..end (inclusive) of the OLD/NEW file,
+        bitmap[i] is 1 if line start + i is removed (OLD) / added (NEW)
+        """
+        bitmap = bytearray(max(end - start + 1, 0))
+        if oldnew == "OLD":
+            index, starts, changed = self.__old_index, self.__old_starts, REMOVED
+        else:
+            index, starts, changed = self.__new_index, self.__new_starts, ADDED
+        # the hunk containing start (if any), then every hunk starting inside the range
+        i = max(bisect_right(starts, start) - 1, 0)
+        while i < len(index) and starts[i] <= end:
+            hunk = index[i]
+            rows = hunk._old_rows if changed == REMOVED else hunk._new_rows
+            types = hunk._types
+            first = starts[i]
+            for k in range(max(start - first, 0), min(end - first + 1, len(rows))):
+                if types[rows[k]] == changed:
+                    bitmap[first + k - start] = 1
+            i += 1
+        return bitmap
+
+
+
+class FileDiff(Diff):
+    """
+    the hunks of one file inside a PatchSet, a Diff with its file header
+    interface:
+        head(FileHead)
+        old_path, new_path
+        hunks, heads, and every Diff lookup
+    """
+    def __init__(self, head: FileHead, hunks: list[Hunk]):
+        self.head: FileHead = head
+        self.old_path: str or None = head.old_path
+        self.new_path: str or None = head.new_path
+        self._set_hunks(hunks)
+
+    @property
+    def path(self) -> str or None:
+        return self.new_path if self.new_path is not None else self.old_path
+
+    def __str__(self):
+        return f"[ {self.old_path} -> {self.new_path} ]\n" + super().__str__()
+
+
+
+class PatchSet:
+    """
+    a multi-file unified diff (git format-patch / git diff of a whole commit), split per file in a single pass
+    interface:
+        files(iterable of FileDiff)
+        paths
+        getfile(path) or patchset[path]
+    """
+    def __init__(self, content: str):
+        self.__set_files(self.__parse_files(iter_sections(content.split("\n"))))
+
+    def __set_files(self, files: list[FileDiff]):
+        self.files: list[FileDiff] = files
+        self.__by_path: dict[str, FileDiff] = {}
+        for file in self.files:
+            for path in (file.old_path, file.new_path):
+                if path is not None:
+                    self.__by_path.setdefault(path, file)
+        # a new path always wins over another file's old path (renames)
+        for file in self.files:
+            if file.new_path is not None:
+                self.__by_path[file.new_path] = file
+
+    @staticmethod
+    def __parse_files(sections: Iterable[FileHead or Hunk]) -> list[FileDiff]:
+        files = []
+        head = None
+        hunks = []
+        for section in sections:
+            if isinstance(section, FileHead):
+                if head is not None or hunks:
+                    files.append(FileDiff(head or FileHead(None, None, []), hunks))
+                head, hunks = section, []
+            else:
+                hunks.append(section)
+        if head is not None or hunks:
+            files.append(FileDiff(head or FileHead(None, None, []), hunks))
+        return files
+
+    @classmethod
+    def from_file(cls, path: str):
+        patchset = cls.__new__(cls)
+        patchset.__set_files(cls.__parse_files(Diff.iter_file(path)))
+        return patchset
+
+    @classmethod
+    def from_str(cls, content: str):
+        return cls(content)
+
+    @property
+    def paths(self) -> list[str]:
+        return [file.path for file in self.files]
+
+    def getfile(self, path: str) -> FileDiff or None:
+        return self.__by_path.get(path)
+
+    def __getitem__(self, path: str) -> FileDiff:
+        return self.__by_path[path]
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+    def __str__(self):
+        return ("#"*20 + "   PATCH SET   " + "#"*20 + "\n"
+                + f"{' '*20}   {str(len(self.files)): ^3} FILES   {' '*20}" + "\n"
+                + "\n".join([str(file) for file in self.files]))
 
 
 
 if __name__ == "__main__":
-    diff = Diff.from_file("/Users/wh/Project/hust/SecModel/fanyi_model/CVEfixes_for_slice-main/CWE-18/krb5/CVE-2015-2696/CVE-2015-2696_CWE-18_e04f0283516e80d2f93366e0d479d13c9b5c8c2a_iakerb.c.diff")
+    import sys
+    # python diff.py path/to/your/diff
+    diff = Diff.from_file(sys.argv[1])
     print(diff)
     line = diff.getline(47, "OLD")
     print(line)
@@ -1,4 +1,7 @@
 import tree_sitter
+from dataclasses import dataclass
+from typing import Callable
+
 from astq import *
 
 from enum import IntEnum
@@ -23,21 +26,108 @@ from enum import IntEnum
 
 
 
+FUNCTION_SEXPRESSION = """
+(function_definition
+    type: (_) @return_type
+    (function_declarator
+        declarator: (_) @func_name
+        (parameter_list) @parameter_list
+    )
+    body: (_) @body
+) @func_node
+"""
+
+
+@dataclass
+class FunctionRecord:
+    """
+    Function的可pickle/可序列化摘要, 不含tree_sitter.Node
+    """
+    func_name: str
+    return_type: str
+    parameter_list: str
+    range: tuple[int, int]
+    byte_range: tuple[int, int]
+    body_byte_range: tuple[int, int] or None
+
+
 class Function:
     def __init__(self, node: tree_sitter.Node,
                  return_type,
                  func_name,
                  parameter_list,
                  body,
-                 global_ast=None
+                 global_ast=None,
+                 body_node: tree_sitter.Node = None
                  ):
-        self.node: tree_sitter.Node = node
+        self._node: tree_sitter.Node = node
         self.range = (node.range.start_point.row, node.range.end_point.row)
+        self.byte_range = (node.start_byte, node.end_byte)
         self.return_type: str = return_type
         self.func_name: str = func_name
         self.parameter_list: str = parameter_list
-        self.body: tree_sitter.Node = body
-        self.global_ast: AST = global_ast
+        self.body: str = body
+        self._body_node: tree_sitter.Node = body_node
+        self.body_byte_range = (body_node.start_byte, body_node.end_byte) if body_node is not None else None
+        self._global_ast: AST = global_ast
+        # 从缓存恢复的函数没有节点, 第一次访问node/body_node/global_ast时才解析并定位
+        self._ast_loader: Callable[[], AST] or None = None
+
+    @property
+    def node(self) -> tree_sitter.Node:
+        self.__resolve()
+        return self._node
+
+    @property
+    def body_node(self) -> tree_sitter.Node:
+        self.__resolve()
+        return self._body_node
+
+    @property
+    def global_ast(self) -> AST:
+        self.__resolve()
+        return self._global_ast
+
+    def __resolve(self):
+        if self._ast_loader is None:
+            return
+        ast = self._ast_loader()
+        self._ast_loader = None
+        self._global_ast = ast
+        node = ast.root_node.descendant_for_byte_range(*self.byte_range)
+        self._node = node
+        self._body_node = node.child_by_field_name("body") if node is not None else None
+
+    def to_record(self) -> FunctionRecord:
+        return FunctionRecord(func_name=self.func_name,
+                              return_type=self.return_type,
+                              parameter_list=self.parameter_list,
+                              range=self.range,
+                              byte_range=self.byte_range,
+                              body_byte_range=self.body_byte_range)
+
+    @classmethod
+    def from_record(cls, record: FunctionRecord, code_bytes: bytes, ast_loader: Callable[[], AST]):
+        """
+        不经过tree-sitter, 由记录恢复Function, 节点在第一次访问时由ast_loader解析得到
+        param: record: 函数记录
+        param: code_bytes: 函数所在文件的代码, 用于取body文本
+        param: ast_loader: 返回函数所在文件AST的函数
+        """
+        function = cls.__new__(cls)
+        function._node = None
+        function._body_node = None
+        function._global_ast = None
+        function._ast_loader = ast_loader
+        function.range = tuple(record.range)
+        function.byte_range = tuple(record.byte_range)
+        function.return_type = record.return_type
+        function.func_name = record.func_name
+        function.parameter_list = record.parameter_list
+        function.body_byte_range = tuple(record.body_byte_range) if record.body_byte_range is not None else None
+        function.body = (code_bytes[function.body_byte_range[0]:function.body_byte_range[1]].decode("utf-8")
+                         if function.body_byte_range is not None else None)
+        return function
 
     # def __parse_statements(self):
     #     statements_and_if_for =  self.global_ast.query(By.All, layer=1, node=self.body)
@@ -53,19 +143,47 @@ class Function:
 
     @classmethod
     def from_str(cls, function_code: str):
-        func_SExpression = """
-                (function_definition
-                	type: (_) @return_type
-           	        (function_declarator
-            	        declarator: (_) @func_name
-                        (parameter_list) @parameter_list
-                    )
-                    body: (_) @body 
-                )
-                """
         func_ast = AST.from_code(function_code)
-        res = func_ast.query(By.SExpression, func_SExpression)
-        return Function(node=func_ast.root_node, return_type=text(res["return_type"][0]), func_name=text(res["func_name"][0]), parameter_list=text(res["parameter_list"][0]), body=text(res["body"][0]))
+        res = func_ast.query(By.SExpression, FUNCTION_SEXPRESSION)
+        return Function(node=func_ast.root_node, return_type=text(res["return_type"][0]), func_name=text(res["func_name"][0]), parameter_list=text(res["parameter_list"][0]), body=text(res["body"][0]),
+                        global_ast=func_ast, body_node=res["body"][0])
+
+    @classmethod
+    def from_node(cls, node: tree_sitter.Node, ast: AST):
+        """
+        直接从已有的树上读取函数信息, 不重新解析, range为在原文件中的行号
+        param: node: function_definition节点
+        param: ast: node所在的AST
+        """
+        for captures in ast.matches(FUNCTION_SEXPRESSION, node=node, depth=0):
+            if captures["func_node"][0] == node:
+                return cls.from_captures(captures, ast)
+        return None
+
+    def rebind(self, node: tree_sitter.Node, ast: AST):
+        """
+        文本没有变化的函数在另一棵树上的对应节点(如增量解析之后), 复用已提取的信息, 不再查询
+        param: node: 新树上对应的function_definition节点
+        param: ast: node所在的AST
+        """
+        return Function(node=node, return_type=self.return_type, func_name=self.func_name,
+                        parameter_list=self.parameter_list, body=self.body, global_ast=ast,
+                        body_node=node.child_by_field_name("body"))
+
+    @classmethod
+    def from_captures(cls, captures: dict[str, list[tree_sitter.Node]], ast: AST):
+        """
+        param: captures: FUNCTION_SEXPRESSION的一个match
+        param: ast: captures所在的AST
+        """
+        body = captures["body"][0]
+        return cls(node=captures["func_node"][0],
+                   return_type=ast.text(captures["return_type"][0]),
+                   func_name=ast.text(captures["func_name"][0]),
+                   parameter_list=ast.text(captures["parameter_list"][0]),
+                   body=ast.text(body),
+                   global_ast=ast,
+                   body_node=body)
 
 
 
@@ -0,0 +1,175 @@
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Iterable, Iterator, Literal
+
+"""
+use case
+metrics.enable()
+ast = AST(code)
+ast.query(By.Type, "identifier")
+metrics.snapshot()
+# {"counters": {"query_cache.miss": 1, ...},
+#  "stats": {"parse": {"count": 1, "total": 0.0012, "max": 0.0012, "mean": 0.0012}, "query.Type": {...}, ...}}
+
+with metrics.scope() as scoped:     # collect only what happens inside the block, enabled for its duration
+    OldNewFile(code, "OLD")
+scoped.snapshot()
+
+metrics.add_sink(lambda kind, name, value: print(kind, name, value))   # sinks only see events while enabled
+"""
+
+Sink = Callable[[Literal["count", "observe"], str, float], None]
+
+
+class Metrics:
+    """
+    opt-in counters and distributions for the hot paths, disabled by default
+    instrumented code checks `metrics.enabled` before doing any work, so a disabled Metrics costs one attribute read
+    counters: count(name, n) adds up events (query cache hits, parses, ...)
+    stats: observe(name, value) keeps count/total/max of a value (seconds of a parse, nodes of a traversal, ...)
+    every recorded event is also passed to the sinks, a Metrics is itself a sink
+    interface:
+        enabled, enable(), disable()
+        count(name, n)
+        observe(name, value)
+        timing(name)
+        timed(name)
+        counted(name, iterable)
+        snapshot()
+        reset()
+        add_sink(sink), remove_sink(sink)
+        scope()
+    """
+
+    def __init__(self, enabled: bool = False):
+        # enabled: the instrumented code records events; _collect: this Metrics aggregates them itself,
+        # a scope turns on the former only, so the events go to the scope and not into this snapshot
+        self.enabled = enabled
+        self._collect = enabled
+        self._scopes = 0
+        self._counters: dict[str, int] = {}
+        self._stats: dict[str, list[float]] = {}
+        self._sinks: list[Sink] = []
+        self._lock = threading.Lock()
+
+    def enable(self):
+        with self._lock:
+            self._collect = self.enabled = True
+
+    def disable(self):
+        with self._lock:
+            self._collect = False
+            self.enabled = self._scopes > 0
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            if self._collect:
+                self._counters[name] = self._counters.get(name, 0) + n
+            sinks = self._sinks
+        for sink in sinks:
+            sink("count", name, n)
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            if self._collect:
+                stat = self._stats.get(name)
+                if stat is None:
+                    self._stats[name] = [1, value, value]
+                else:
+                    stat[0] += 1
+                    stat[1] += value
+                    if value > stat[2]:
+                        stat[2] = value
+            sinks = self._sinks
+        for sink in sinks:
+            sink("observe", name, value)
+
+    def __call__(self, kind: Literal["count", "observe"], name: str, value: float):
+        if kind == "count":
+            self.count(name, value)
+        else:
+            self.observe(name, value)
+
+    @contextmanager
+    def timing(self, name: str):
+        """observe the seconds spent in the block under name, a no-op when disabled"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name: str = None):
+        """decorator form of timing, name defaults to the function's qualified name"""
+        def decorator(func):
+            metric = name or func.__qualname__
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(metric, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def counted(self, name: str, iterable: Iterable) -> Iterator:
+        """pass iterable through and observe how many items were taken from it, once the iteration ends or stops"""
+        taken = 0
+        try:
+            for item in iterable:
+                taken += 1
+                yield item
+        finally:
+            self.observe(name, taken)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"counters": dict(self._counters),
+                    "stats": {name: {"count": count, "total": total, "max": maximum, "mean": total / count}
+                              for name, (count, total, maximum) in self._stats.items()}}
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._stats = {}
+
+    def add_sink(self, sink: Sink):
+        with self._lock:
+            # copy on write, recording iterates the list outside the lock
+            self._sinks = [*self._sinks, sink]
+
+    def remove_sink(self, sink: Sink):
+        with self._lock:
+            self._sinks = [s for s in self._sinks if s is not sink]
+
+    @contextmanager
+    def scope(self):
+        """
+        collect the events of the block into a fresh Metrics, which is yielded
+        instrumentation is on for the duration of the block, events from other threads during the block are
+        collected too; this Metrics only aggregates them as well if it was enabled itself
+        """
+        scoped = Metrics(enabled=True)
+        self.add_sink(scoped)
+        with self._lock:
+            self._scopes += 1
+            self.enabled = True
+        try:
+            yield scoped
+        finally:
+            with self._lock:
+                self._scopes -= 1
+                self.enabled = self._collect or self._scopes > 0
+            self.remove_sink(scoped)
+
+
+metrics = Metrics()
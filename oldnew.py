@@ -2,7 +2,11 @@ from typing import Literal
 
 import tree_sitter
 
+from bisect import bisect_right
+from dataclasses import dataclass, field
+
 from astq import *
+from diff import *
 from func import *
 
 
@@ -21,34 +25,140 @@ from func import *
 #         pass
 
 class OldNewFile:
-    def __init__(self, code: str, type: Literal["OLD", "NEW"], filename: str = None):
+    def __init__(self, code: str, type: Literal["OLD", "NEW"], filename: str = None,
+                 ast: AST = None, functions: list[Function] = None, cache=None):
+        """
+        param: cache: FunctionCache, 命中时不运行tree-sitter, 直接由缓存的记录构建函数, ast在第一次访问时才解析
+        """
         self.type = type
-        self.ast = AST(code)
+        self._code = code
+        self._ast: AST or None = ast
         self.filename = filename
-        self.functions: list[Function] = self.__parse_functions()
-        node = self.ast.root_node
-        self.range = (node.range.start_point.row, node.range.end_point.row)
+        # 由from_diff推导出来的文件才有, diff改动到的函数
+        self.changed_functions: list[Function] or None = None
+        if functions is None and ast is None and cache is not None:
+            code_bytes = code.encode("utf-8")
+            entry = cache.get(code_bytes)
+            if entry is not None:
+                self.range, records = entry
+                self.functions: list[Function] = [Function.from_record(record, code_bytes, lambda: self.ast)
+                                                  for record in records]
+            else:
+                self.functions = self.__parse_functions()
+                self.range = self.__range()
+                cache.put(code_bytes, self.range, [function.to_record() for function in self.functions])
+            return
+        self.functions = functions if functions is not None else self.__parse_functions()
+        self.range = self.__range()
         # self.classes: list[Class] = self.__parse_classes()
         # self.global_variable: Variable = self.__parse_global_variable()
 
 
+    @property
+    def ast(self) -> AST:
+        if self._ast is None:
+            self._ast = AST(self._code)
+        return self._ast
+
+    def __range(self) -> tuple[int, int]:
+        node = self.ast.root_node
+        return node.range.start_point.row, node.range.end_point.row
+
     def __parse_functions(self):
-        func_SExpression = """
-        (function_definition
-        	type: (_)
-   	        (function_declarator
-    	        declarator: (_) 
-                (parameter_list)
-            )
-            body: (_)
-        ) @func_node
-        """
-        query_res = self.ast.query(By.SExpression, func_SExpression)
+        # 一次查询拿到所有函数的各个部分, 直接在原树上构建Function, 不再逐个重新解析
         function_list: list[Function] = []
-        for func_node in query_res["func_node"]:
-            function_list.append(Function.from_str(text(func_node)))
+        for captures in self.ast.matches(FUNCTION_SEXPRESSION):
+            function_list.append(Function.from_captures(captures, self.ast))
+        function_list.sort(key=lambda function: function.byte_range)
         return function_list
 
+    @classmethod
+    def from_diff(cls, old: "OldNewFile", diff: Diff, filename: str = None) -> "OldNewFile":
+        """
+        把diff的每个hunk作为增量修改作用在OLD的树上, 推导出NEW文件, 不再完整解析NEW
+        没被改动的函数直接在新树上按平移后的位置取出, 只有被改动的函数重新查询, 记在changed_functions里
+        注意: tree-sitter的树不能复制, 推导后old的树会被增量重建, old.functions也随之刷新
+        param: old: OLD文件
+        param: diff: OLD到NEW的diff
+        """
+        code_bytes = old.ast.code_bytes
+        # line_offsets[i]: 第i+1行的起始字节
+        line_offsets = [0]
+        position = code_bytes.find(b"\n")
+        while position != -1:
+            line_offsets.append(position + 1)
+            position = code_bytes.find(b"\n", position + 1)
+
+        def offset(index: int) -> int:
+            return line_offsets[index - 1] if index - 1 < len(line_offsets) else len(code_bytes)
+
+        edits = []
+        for hunk in diff.hunks:
+            for old_index, old_count, new_text in hunk.changes():
+                edits.append((offset(old_index), offset(old_index + old_count), new_text.encode("utf-8")))
+        edits.sort(key=lambda edit: edit[0])
+
+        old_functions = old.functions
+        new_ast, _ = old.ast.derive(edits)
+        # 推导会增量重建old的树, 原来的节点失效, 函数范围不变, 直接在重建的树上重新定位
+        old_nodes = [cls.__function_node(old.ast, function.byte_range) for function in old_functions]
+        if all(node is not None for node in old_nodes):
+            old.functions = [function.rebind(node, old.ast) for function, node in zip(old_functions, old_nodes)]
+        else:
+            old.functions = old.__parse_functions()
+
+        # 每处修改在NEW中的范围, 以及它之后的代码整体平移的字节数
+        edit_starts = []
+        shifts = []
+        new_edits = []
+        shift = 0
+        for start_byte, old_end_byte, new_text in edits:
+            new_edits.append((start_byte + shift, start_byte + shift + len(new_text)))
+            shift += len(new_text) - (old_end_byte - start_byte)
+            edit_starts.append(start_byte)
+            shifts.append(shift)
+
+        def touches(start_byte, end_byte, edit_start, edit_end):
+            if edit_start == edit_end:
+                return start_byte < edit_start < end_byte
+            return edit_start < end_byte and edit_end > start_byte
+
+        unchanged = {}
+        scan_ranges = list(new_edits)
+        for function in old_functions:
+            start_byte, end_byte = function.byte_range
+            if any(touches(start_byte, end_byte, edit_start, old_end_byte) for edit_start, old_end_byte, _ in edits):
+                continue
+            i = bisect_right(edit_starts, start_byte)
+            function_shift = shifts[i - 1] if i else 0
+            new_range = (start_byte + function_shift, end_byte + function_shift)
+            node = cls.__function_node(new_ast, new_range)
+            if node is None:
+                scan_ranges.append(new_range)
+            else:
+                unchanged[new_range] = function.rebind(node, new_ast)
+
+        changed = {}
+        for edit_start, edit_end in scan_ranges:
+            for captures in new_ast.matches(FUNCTION_SEXPRESSION, byte_range=(edit_start, max(edit_end, edit_start + 1))):
+                node = captures["func_node"][0]
+                if node.byte_range in unchanged or node.byte_range in changed:
+                    continue
+                if any(touches(node.start_byte, node.end_byte, s, e) for s, e in scan_ranges):
+                    changed[node.byte_range] = Function.from_captures(captures, new_ast)
+
+        functions = sorted([*unchanged.values(), *changed.values()], key=lambda function: function.byte_range)
+        new = cls(None, "NEW", filename, ast=new_ast, functions=functions)
+        new.changed_functions = sorted(changed.values(), key=lambda function: function.byte_range)
+        return new
+
+    @staticmethod
+    def __function_node(ast: AST, byte_range: tuple[int, int]) -> tree_sitter.Node or None:
+        node = ast.root_node.descendant_for_byte_range(*byte_range)
+        if node is not None and node.type == "function_definition" and node.byte_range == byte_range:
+            return node
+        return None
+
     def __str__(self):
         ret_str = "%"*30 + "\n"
         ret_str += f"[ filename ] {self.filename}\n"
@@ -79,6 +189,109 @@ class OldNewFile:
 
 
 
+@dataclass
+class FunctionChange:
+    """
+    被diff改动到的一个函数, OLD/NEW两侧按函数名和签名配对, 新增/删除的函数另一侧为None
+    old/new: Function 或 FunctionRecord
+    old_lines: 函数内被删除的行号(OLD文件, 从1开始)
+    new_lines: 函数内新增的行号(NEW文件, 从1开始)
+    """
+    old: Function or FunctionRecord or None
+    new: Function or FunctionRecord or None
+    old_lines: list[int] = field(default_factory=list)
+    new_lines: list[int] = field(default_factory=list)
+
+    @property
+    def func_name(self) -> str:
+        return (self.new if self.new is not None else self.old).func_name
+
+
+def sweep_lines(functions: list, indices: list[int]) -> list[list[int]]:
+    """
+    把升序的行号分到各个函数中, 函数和行号都只扫一遍
+    param: functions: 有range(从0开始的起止行)的Function/FunctionRecord, 按起始行升序
+    param: indices: 升序的行号, 从1开始
+    return: 和functions一一对应, 每个函数范围内的行号
+    """
+    res = []
+    j = 0
+    for function in functions:
+        start, end = function.range[0] + 1, function.range[1] + 1
+        # 函数按起始行排序, 所以j只前进不回退; 嵌套的函数(如局部类的方法)从j开始往后扫, 不影响j
+        while j < len(indices) and indices[j] < start:
+            j += 1
+        k = j
+        while k < len(indices) and indices[k] <= end:
+            k += 1
+        res.append(indices[j:k])
+    return res
+
+
+def _signature(function) -> tuple[str, str, str]:
+    return function.func_name, " ".join(function.return_type.split()), " ".join(function.parameter_list.split())
+
+
+def join_functions(old_functions: list, new_functions: list, diff: Diff) -> list[FunctionChange]:
+    """
+    diff改动到的函数: 删除的行和OLD的函数、新增的行和NEW的函数分别排序后一次扫描对齐,
+    再把OLD/NEW的函数先按(函数名, 返回类型, 参数列表)配对, 剩下的按唯一的函数名配对
+    param: old_functions: OLD文件的函数, Function或FunctionRecord(如corpus的FileRecord.functions)
+    param: new_functions: NEW文件的函数
+    param: diff: OLD到NEW的diff
+    return: 至少一侧有改动行的函数对, 按所在位置排序
+    """
+    old_functions = sorted(old_functions, key=lambda function: function.range)
+    new_functions = sorted(new_functions, key=lambda function: function.range)
+    old_lines = sweep_lines(old_functions, diff.changed_indices("OLD"))
+    new_lines = sweep_lines(new_functions, diff.changed_indices("NEW"))
+
+    # 按签名配对, 同签名的多个函数(如#ifdef的不同分支)按出现顺序配对
+    new_by_signature: dict[tuple, list[int]] = {}
+    for j, function in enumerate(new_functions):
+        new_by_signature.setdefault(_signature(function), []).append(j)
+    for candidates in new_by_signature.values():
+        candidates.reverse()
+    pair_of_old: list[int or None] = [None] * len(old_functions)
+    paired_new = [False] * len(new_functions)
+    for i, function in enumerate(old_functions):
+        candidates = new_by_signature.get(_signature(function))
+        if candidates:
+            j = candidates.pop()
+            pair_of_old[i] = j
+            paired_new[j] = True
+
+    # 签名变了的函数, 两侧都只剩一个同名函数时按函数名配对
+    old_by_name: dict[str, list[int]] = {}
+    for i, function in enumerate(old_functions):
+        if pair_of_old[i] is None:
+            old_by_name.setdefault(function.func_name, []).append(i)
+    new_by_name: dict[str, list[int]] = {}
+    for j, function in enumerate(new_functions):
+        if not paired_new[j]:
+            new_by_name.setdefault(function.func_name, []).append(j)
+    for name, olds in old_by_name.items():
+        news = new_by_name.get(name)
+        if len(olds) == 1 and news is not None and len(news) == 1:
+            pair_of_old[olds[0]] = news[0]
+            paired_new[news[0]] = True
+
+    changes = []
+    for i, function in enumerate(old_functions):
+        j = pair_of_old[i]
+        if j is None:
+            if old_lines[i]:
+                changes.append(FunctionChange(old=function, new=None, old_lines=old_lines[i]))
+        elif old_lines[i] or new_lines[j]:
+            changes.append(FunctionChange(old=function, new=new_functions[j],
+                                          old_lines=old_lines[i], new_lines=new_lines[j]))
+    for j, function in enumerate(new_functions):
+        if not paired_new[j] and new_lines[j]:
+            changes.append(FunctionChange(old=None, new=function, new_lines=new_lines[j]))
+    changes.sort(key=lambda change: (change.new.range if change.new is not None else change.old.range))
+    return changes
+
+
 if __name__ == "__main__":
     code = """
 SSU SYSCALL_DEFINE1(setfsuid, uid_t, uid)
@@ -0,0 +1,156 @@
+import itertools
+
+from astq import *
+
+CODE = "\n".join(f"""
+int func_{i}(int a, char *buf)
+{{
+    int ret = helper_{i}(a);
+    if (ret > {i})
+        return ret + buf[0];
+    return ret;
+}}""" for i in range(20))
+
+
+def byte_ranges(nodes):
+    return [node.byte_range for node in nodes]
+
+
+def test_type_index_ignores_nodes_of_a_derived_tree():
+    old = AST(CODE, index=True)
+    new, _ = old.derive([(0, 0, b"// comment here\n")])
+    plain = AST(CODE)
+    for body in new.query(By.Type, "compound_statement"):
+        assert byte_ranges(old.query(By.Type, "identifier", node=body)) == \
+               byte_ranges(plain.query(By.Type, "identifier", node=body))
+
+
+def test_type_index_ignores_nodes_from_before_an_edit():
+    ast = AST(CODE, index=True)
+    ast.type_index()
+    kept = ast.query(By.Type, "compound_statement")[5]
+    ast.apply_edits([(0, 0, b"// comment here\n")])
+    assert byte_ranges(ast.query(By.Type, "identifier", node=kept)) == \
+           byte_ranges(AST(CODE).query(By.Type, "identifier", node=kept))
+
+
+def preorder_nodes(node):
+    yield node
+    for child in node.children:
+        yield from preorder_nodes(child)
+
+
+def levelorder_nodes(node, depth):
+    frontier = [node]
+    for _ in range(depth + 1):
+        yield from frontier
+        frontier = [child for n in frontier for child in n.children]
+
+
+def test_concurrent_nested_nest_queries_on_one_ast():
+    # nest=True queries from many threads, including one nested inside another's predicate, must each stop
+    # at their own first match; a tiny switch interval makes the threads interleave inside single queries
+    import random
+    import sys
+    from concurrent.futures import ThreadPoolExecutor
+
+    ast = AST(CODE)
+    types = ["identifier", "call_expression", "if_statement", "return_statement",
+             "subscript_expression", "number_literal", "binary_expression"]
+    functions = ast.query(By.Type, "function_definition")
+
+    def case(seed: int):
+        rnd = random.Random(seed)
+        return seed % 3, rnd.choice(types), rnd.choice(functions), rnd.randint(1, 6)
+
+    def run(seed: int):
+        kind, type, function, depth = case(seed)
+        if kind == 0:
+            res = ast.query(By.Type, type, node=function, nest=True)
+        elif kind == 1:
+            res = ast.query(By.Type, type, node=function, nest=True, depth=depth)
+        else:
+            res = ast.query(By.Predicate, lambda node: node.type == "if_statement"
+                            and len(ast.query(By.Type, type, node=node, nest=True)) > 0,
+                            node=function, nest=True)
+        return [node.byte_range for node in res]
+
+    def expected(seed: int):
+        # the answer worked out from node.children alone, independent of AST's traversal state
+        kind, type, function, depth = case(seed)
+        if kind == 0:
+            candidates = (node for node in preorder_nodes(function) if node.type == type)
+        elif kind == 1:
+            candidates = (node for node in levelorder_nodes(function, depth) if node.type == type)
+        else:
+            candidates = (node for node in preorder_nodes(function) if node.type == "if_statement"
+                          and any(n.type == type for n in preorder_nodes(node)))
+        return [node.byte_range for node in itertools.islice(candidates, 1)]
+
+    seeds = range(3000)
+    answers = [expected(seed) for seed in seeds]
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(run, seeds))
+    finally:
+        sys.setswitchinterval(interval)
+    assert [seed for seed in seeds if results[seed] != answers[seed]] == []
+
+
+def test_iquery_leaf_does_not_depend_on_the_index():
+    for by, param in [(By.FuzzyType, "statement"), (By.Type, "identifier"), (By.Types, ["identifier", "if_statement"])]:
+        plain = byte_ranges(AST(CODE).iquery(by, param, leaf=True))
+        indexed = byte_ranges(AST(CODE, index=True).iquery(by, param, leaf=True))
+        assert plain == indexed
+
+
+def test_sexpression_depth_zero_matches_only_the_node():
+    ast = AST(CODE)
+    function = ast.query(By.Type, "function_definition")[0]
+    pattern = "(function_definition) @f"
+    assert byte_ranges(ast.query(By.SExpression, pattern, node=function, depth=0)["f"]) == [function.byte_range]
+    assert [byte_ranges(m["f"]) for m in ast.matches(pattern, node=function, depth=0)] == [[function.byte_range]]
+    body = function.child_by_field_name("body")
+    assert ast.query(By.SExpression, "(return_statement) @r", node=body, depth=0) == {}
+    assert len(ast.query(By.SExpression, "(return_statement) @r", node=body, depth=1)["r"]) == 1
+
+
+def test_sexpression_queries_from_many_threads():
+    import sys
+    from concurrent.futures import ThreadPoolExecutor
+
+    ast = AST(CODE)
+    functions = ast.query(By.Type, "function_definition")
+    pattern = "(call_expression function: (identifier) @callee)"
+
+    def run(i: int):
+        function = functions[i % len(functions)]
+        return byte_ranges(ast.query(By.SExpression, pattern, byte_range=function.byte_range)["callee"])
+
+    expected = [run(i) for i in range(len(functions))]
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(run, range(2000)))
+    finally:
+        sys.setswitchinterval(interval)
+    assert all(results[i] == expected[i % len(functions)] for i in range(2000))
+
+
+def test_reregistering_a_language_rebuilds_the_thread_parsers():
+    from concurrent.futures import ThreadPoolExecutor
+    import tree_sitter_cpp
+    old = AST(CODE)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        executor.submit(registry.parser, "cpp").result()
+        try:
+            register_language("cpp", tree_sitter_cpp.language)
+            assert AST("int x;").lang is registry.parser("cpp").language
+            assert executor.submit(lambda: registry.parser("cpp").language).result() is registry.language("cpp")
+            # an AST from before the register keeps parsing with its own grammar
+            assert old.parser.language is old.lang
+        finally:
+            register_language("cpp", "tree_sitter_cpp")
@@ -0,0 +1,41 @@
+import multiprocessing
+
+from cache import *
+
+
+def records(i: int) -> list[FunctionRecord]:
+    return [FunctionRecord(f"func_{i}", "int", "(int a)", (0, 3), (0, 39), None)]
+
+
+def put_many(directory: str, max_bytes: int, start: int, count: int):
+    cache = FunctionCache(directory, max_bytes=max_bytes)
+    for i in range(start, start + count):
+        cache.put(f"file {i}".encode("utf-8"), (0, 10), records(i))
+
+
+def test_instances_on_one_directory_share_the_bound(tmp_path):
+    caches = [FunctionCache(str(tmp_path), max_bytes=20000) for _ in range(8)]
+    for i in range(400):
+        caches[i % len(caches)].put(f"file {i}".encode("utf-8"), (0, 10), records(i))
+    assert caches[0].info()["bytes"] <= 20000
+    assert caches[0].get(b"file 399") is not None
+
+
+def test_processes_on_one_directory_share_the_bound(tmp_path):
+    processes = [multiprocessing.Process(target=put_many, args=(str(tmp_path), 20000, n * 100, 100))
+                 for n in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+    assert FunctionCache(str(tmp_path), max_bytes=20000).info()["bytes"] <= 20000
+
+
+def test_overwrites_are_not_counted_twice(tmp_path):
+    first, second = FunctionCache(str(tmp_path), max_bytes=20000), FunctionCache(str(tmp_path), max_bytes=20000)
+    for _ in range(200):
+        first.put(b"file", (0, 10), records(0))
+        second.put(b"file", (0, 10), records(0))
+    with open(os.path.join(str(tmp_path), SIZE_FILE)) as f:
+        assert int(f.read()) == first.info()["bytes"]
@@ -0,0 +1,50 @@
+from diff import *
+
+FORMAT_PATCH = """From 0123456789abcdef0123456789abcdef01234567 Mon Sep 17 00:00:00 2001
+From: Dev <dev@example.com>
+Date: Mon, 1 Jan 2024 00:00:00 +0000
+Subject: [PATCH] Accept short hunk heads
+
+A head such as
+@@ -5 +5 @@
+has no ",len", and an indented one too:
+    @@ -7,2 +7,3 @@ int f(void)
+---
+ a.c | 2 +-
+ b.c | 1 +
+ 2 files changed, 2 insertions(+), 1 deletion(-)
+
+diff --git a/a.c b/a.c
+index 1111111..2222222 100644
+--- a/a.c
++++ b/a.c
+@@ -1,3 +1,3 @@ int main(void)
+ int a;
+-int b;
++int c;
+ int d;
+diff --git a/b.c b/b.c
+index 3333333..4444444 100644
+--- a/b.c
++++ b/b.c
+@@ -10,2 +10,3 @@
+ x;
++y;
+ z;
+--
+2.43.0
+"""
+
+
+def test_commit_message_heads_are_not_hunks():
+    patchset = PatchSet(FORMAT_PATCH)
+    assert patchset.paths == ["a.c", "b.c"]
+    assert [hunk.head for hunk in patchset["a.c"].hunks] == [Head(1, 3, 3, 1, 3, 3)]
+    assert [hunk.head for hunk in patchset["b.c"].hunks] == [Head(10, 2, 11, 10, 3, 12)]
+    assert patchset["a.c"].getline(2, "OLD").line_content == "int b;"
+    assert patchset["b.c"].getline(11, "NEW").type == "added"
+
+
+def test_bare_hunks_without_file_header():
+    sections = list(iter_sections("@@ -1 +1 @@\n-a\n+b\n@@ -5,1 +5,1 @@\n-c\n+d".split("\n")))
+    assert [section.head for section in sections] == [Head(1, 1, 1, 1, 1, 1), Head(5, 1, 5, 5, 1, 5)]